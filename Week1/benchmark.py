@@ -0,0 +1,465 @@
+import argparse
+import os
+import random
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from datasets import Dataset, load_dataset
+from tokenizers import Tokenizer
+from torch.nn.parallel import DistributedDataParallel
+
+from config import get_config, get_draft_config, get_tokenizer_file_path, get_weights_file_path
+from dataset import padding_mask, make_masks, make_packed_masks, collate_batch, pack_batch, pack_rows
+from distributed import setup, cleanup
+from metrics import corpus_bleu
+from model import LayerNormalization, MultiHeadAttentionBlock, FeedForwardBlock, EncoderBlock, DecoderBlock
+from quantize import load_quantized_model
+from token_cache import encode_corpus
+from train import configure_process, get_ds, get_or_build_tokenizer, get_model, batch_greedy_decode, beam_search_decode, speculative_decode, get_autocast_dtype, peak_memory_mb, synchronize
+
+def get_device():
+    return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+def timed(fn, device):
+    # wall-clock of fn(), waiting for queued kernels on accelerators
+    synchronize(device)
+    start = time.perf_counter()
+    out = fn()
+    synchronize(device)
+    return out, time.perf_counter() - start
+
+def load_model(config, tokenizer_src, tokenizer_tgt, device):
+    model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    if config['preload']:
+        state = torch.load(get_weights_file_path(config, config['preload']), map_location=device, weights_only=False)
+        model.load_state_dict(state['model_state_dict'])
+    model.eval()
+    return model
+
+def benchmark_decode(config, args):
+    # greedy vs beam search on the same validation batches
+    device = get_device()
+    config['val_batch_size'] = args.batch_size
+    _, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
+    model = load_model(config, tokenizer_src, tokenizer_tgt, device)
+
+    decoders = {
+        'greedy': lambda source, source_mask: batch_greedy_decode(model, source, source_mask, tokenizer_tgt, config['seq_len'], device),
+        f'beam{config["beam_size"]}': lambda source, source_mask: beam_search_decode(
+            model, source, source_mask, tokenizer_tgt, config['seq_len'], device,
+            config['beam_size'], config['length_penalty'], config['max_len_a'], config['max_len_b']),
+    }
+    elapsed = {name: 0.0 for name in decoders}
+    sentences = 0
+
+    with torch.no_grad():
+        for i, batch in enumerate(val_dataloader):
+            if i == args.num_batches:
+                break
+            encoder_input = batch['encoder_input'].to(device)
+            encoder_mask = padding_mask(batch['src_len'].to(device), encoder_input.size(1))
+            for name, decode in decoders.items():
+                _, seconds = timed(lambda: decode(encoder_input, encoder_mask), device)
+                elapsed[name] += seconds
+            sentences += encoder_input.size(0)
+
+    print(f'{sentences} sentences, batch size {args.batch_size}, device {device}')
+    print(f'{"decoder":<10} {"sent/s":>10} {"ms/sent":>10}')
+    for name, seconds in elapsed.items():
+        print(f'{name:<10} {sentences / seconds:>10.1f} {1000 * seconds / sentences:>10.2f}')
+
+def benchmark_quantized(config, args):
+    # BLEU and latency of the fp32 model vs its int8 build on the same validation sentences (CPU)
+    device = torch.device('cpu')
+    config['val_batch_size'] = args.batch_size
+    _, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
+    models = {
+        'fp32': load_model(config, tokenizer_src, tokenizer_tgt, device),
+        'int8': load_quantized_model(config, config['preload']),
+    }
+    predictions = {name: [] for name in models}
+    elapsed = {name: 0.0 for name in models}
+    references = []
+
+    with torch.no_grad():
+        for i, batch in enumerate(val_dataloader):
+            if i == args.num_batches:
+                break
+            encoder_input = batch['encoder_input']
+            encoder_mask = padding_mask(batch['src_len'], encoder_input.size(1))
+            references.extend(batch['tgt_text'])
+            for name, model in models.items():
+                model_out, seconds = timed(lambda: batch_greedy_decode(model, encoder_input, encoder_mask, tokenizer_tgt, config['seq_len'], device), device)
+                elapsed[name] += seconds
+                predictions[name].extend(tokenizer_tgt.decode(ids) for ids in model_out.tolist())
+
+    print(f'{len(references)} sentences, batch size {args.batch_size}, {torch.get_num_threads()} threads')
+    print(f'{"model":<6} {"BLEU":>6} {"ms/sent":>10}')
+    for name in models:
+        print(f'{name:<6} {corpus_bleu(predictions[name], references):>6.2f} {1000 * elapsed[name] / len(references):>10.2f}')
+
+def synthetic_batch(batch_size, seq_len, vocab_size, device):
+    # random full-length pairs, the cost of a step does not depend on the token values
+    encoder_input = torch.randint(4, vocab_size, (batch_size, seq_len), device=device)
+    decoder_input = torch.randint(4, vocab_size, (batch_size, seq_len), device=device)
+    label = torch.randint(4, vocab_size, (batch_size, seq_len), device=device)
+    lengths = torch.full((batch_size,), seq_len, device=device)
+    encoder_mask, decoder_mask = make_masks(lengths, lengths, seq_len, seq_len)
+    return encoder_input, encoder_mask, decoder_input, decoder_mask, label
+
+def run_train_steps(config, batch_size, seq_len, vocab_size, steps, warmup, device):
+    # seconds for `steps` training steps on one synthetic batch, after `warmup` untimed ones
+    model = get_model(config, vocab_size, vocab_size).to(device)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'], eps=1e-09)
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=1, label_smoothing=config['label_smoothing']).to(device)
+    autocast_dtype = get_autocast_dtype(config, device)
+    scaler = torch.amp.GradScaler(device.type, enabled=autocast_dtype == torch.float16)
+    encoder_input, encoder_mask, decoder_input, decoder_mask, label = synthetic_batch(batch_size, seq_len, vocab_size, device)
+
+    def step():
+        with torch.autocast(device_type=device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+            proj_output = model(encoder_input, encoder_mask, decoder_input, decoder_mask)
+            loss = loss_fn(proj_output.view(-1, vocab_size), label.view(-1))
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad()
+
+    for _ in range(warmup):
+        step()
+    _, seconds = timed(lambda: [step() for _ in range(steps)], device)
+    return seconds
+
+def benchmark_train_step(config, args):
+    # steps/s and peak memory of one training configuration; run once per setting so the
+    # process-wide peak memory on CPU belongs to that setting alone
+    device = get_device()
+    config['mixed_precision'] = args.mixed_precision
+    seconds = run_train_steps(config, args.batch_size, args.seq_len, args.vocab_size, args.steps, args.warmup, device)
+
+    tokens = args.steps * args.batch_size * args.seq_len
+    print(f'autocast {get_autocast_dtype(config, device)}, batch {args.batch_size} x {args.seq_len}, device {device}')
+    print(f'{args.steps / seconds:.2f} steps/s, {tokens / seconds:.0f} tokens/s, peak memory {peak_memory_mb(device):.0f} MB')
+
+def checkpointing_worker(config, args, batch_size, results):
+    device = get_device()
+    seconds = run_train_steps(config, batch_size, args.seq_len, args.vocab_size, args.steps, args.warmup, device)
+    results.put((seconds, peak_memory_mb(device)))
+
+def benchmark_checkpointing(config, args):
+    # memory/throughput trade-off of activation checkpointing; every cell runs in a fresh process
+    # so its peak memory is its own, and a setting that runs out of memory only fails its cell
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    print(f'{"enc/dec every":>13} {"batch":>6} {"tokens/s":>10} {"peak MB":>10}')
+    for setting in args.settings:
+        encoder_every, decoder_every = (int(k) for k in setting.split(','))
+        config['encoder_checkpoint_every'] = encoder_every
+        config['decoder_checkpoint_every'] = decoder_every
+        for batch_size in args.batch_sizes:
+            process = context.Process(target=checkpointing_worker, args=(config, args, batch_size, results))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                print(f'{setting:>13} {batch_size:>6} {"failed (out of memory?)":>21}')
+                continue
+            seconds, peak = results.get()
+            tokens = args.steps * batch_size * args.seq_len
+            print(f'{setting:>13} {batch_size:>6} {tokens / seconds:>10.0f} {peak:>10.0f}')
+
+class ReferenceLayerNormalization(LayerNormalization):
+    # the original layer norm (separate mean and std reductions), to time the other variants against
+
+    def forward(self, x):
+        dtype = x.dtype
+        x = x.float()
+        mean = x.mean(dim=-1, keepdim=True)
+        std = x.std(dim=-1, keepdim=True)
+        return (self.alpha * (x - mean) / (std + self.eps) + self.bias).to(dtype)
+
+def set_layer_norm(block, variant):
+    # swap every norm of the block for `variant`, keeping its alpha/bias
+    for residual in block.residual_connections:
+        features = residual.norm.alpha.numel()
+        norm = ReferenceLayerNormalization(features) if variant == 'reference' else LayerNormalization(features, unbiased=variant == 'var_mean')
+        norm.load_state_dict(residual.norm.state_dict())
+        residual.norm = norm.to(residual.norm.alpha.device)
+
+def benchmark_layernorm(config, args):
+    # forward+backward time of one encoder and one decoder block per layer norm variant, and the
+    # largest output difference to the original implementation (no dropout, so outputs are comparable)
+    device = get_device()
+    torch.manual_seed(0)
+    d_model, h, d_ff, backend = config['d_model'], 8, 2048, config['attention_backend']
+    blocks = {
+        'encoder': EncoderBlock(d_model, MultiHeadAttentionBlock(d_model, h, 0.0, backend), FeedForwardBlock(d_model, d_ff, 0.0), 0.0).to(device),
+        'decoder': DecoderBlock(d_model, MultiHeadAttentionBlock(d_model, h, 0.0, backend), MultiHeadAttentionBlock(d_model, h, 0.0, backend), FeedForwardBlock(d_model, d_ff, 0.0), 0.0).to(device),
+    }
+    x = torch.randn(args.batch_size, args.seq_len, d_model, device=device, requires_grad=True)
+    encoder_output = torch.randn(args.batch_size, args.seq_len, d_model, device=device)
+    lengths = torch.full((args.batch_size,), args.seq_len, device=device)
+    src_mask, tgt_mask = make_masks(lengths, lengths, args.seq_len, args.seq_len)
+    runs = {
+        'encoder': lambda: blocks['encoder'](x, src_mask),
+        'decoder': lambda: blocks['decoder'](x, encoder_output, src_mask, tgt_mask),
+    }
+
+    reference = {}
+    print(f'{"variant":<12} {"block":<8} {"fwd+bwd ms":>10} {"max diff":>10}')
+    for variant in ['reference', 'var_mean', 'layer_norm']:
+        for name, run in runs.items():
+            set_layer_norm(blocks[name], variant)
+            with torch.no_grad():
+                output = run()
+            reference.setdefault(name, output)
+            diff = (output - reference[name]).abs().max().item()
+
+            for _ in range(args.warmup):
+                run().sum().backward()
+            _, seconds = timed(lambda: [run().sum().backward() for _ in range(args.steps)], device)
+            print(f'{variant:<12} {name:<8} {1000 * seconds / args.steps:>10.2f} {diff:>10.2e}')
+
+def synthetic_corpus(config, num_pairs, seed=0):
+    # num_pairs of random sentences (4-40 words of the saved tokenizers' vocabularies), in the layout of opus_books
+    rng = random.Random(seed)
+    langs = (config['lang_src'], config['lang_tgt'])
+    words = {lang: sorted(Tokenizer.from_file(get_tokenizer_file_path(config, lang)).get_vocab()) for lang in langs}
+    return Dataset.from_dict({'translation': [
+        {lang: ' '.join(rng.choices(words[lang], k=rng.randint(4, 40))) for lang in langs} for _ in range(num_pairs)]})
+
+def tokenize_worker(config, threads, with_loop, num_pairs, results):
+    # a fresh process, so the tokenizers thread pool starts with this size
+    os.environ['RAYON_NUM_THREADS'] = str(threads)
+    if num_pairs:
+        ds_raw = synthetic_corpus(config, num_pairs)
+    else:
+        ds_raw = load_dataset('opus_books', f'{config["lang_src"]}-{config["lang_tgt"]}', split='train')
+    tokenizers = {lang: get_or_build_tokenizer(config, ds_raw, lang) for lang in (config['lang_src'], config['lang_tgt'])}
+
+    loop_seconds = None
+    if with_loop:
+        # the old path: one tokenizer.encode call per sentence
+        start = time.perf_counter()
+        for item in ds_raw:
+            for lang, tokenizer in tokenizers.items():
+                tokenizer.encode(item['translation'][lang])
+        loop_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for lang, tokenizer in tokenizers.items():
+        max(len(ids) for ids in encode_corpus(ds_raw, tokenizer, lang))
+    results.put((loop_seconds, time.perf_counter() - start))
+
+def benchmark_tokenize(config, args):
+    # wall-clock to tokenize both sides of the full corpus, per-sentence loop vs encode_batch per thread count
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    print(f'{"method":<18} {"seconds":>8}')
+    for i, threads in enumerate(args.threads):
+        process = context.Process(target=tokenize_worker, args=(config, threads, i == 0, args.synthetic_pairs, results))
+        process.start()
+        process.join()
+        loop_seconds, batch_seconds = results.get()
+        if loop_seconds is not None:
+            print(f'{"encode loop":<18} {loop_seconds:>8.2f}')
+        print(f'{f"encode_batch x{threads}":<18} {batch_seconds:>8.2f}')
+
+def benchmark_packing(config, args):
+    # Checks that packing is exact: the loss of every pair in packed rows against the same pair run on
+    # its own (eval mode, so without dropout), plus how much of the batch is real tokens either way.
+    device = get_device()
+    config['packing'] = False
+    train_dataloader, _, tokenizer_src, tokenizer_tgt = get_ds(config)
+    model = load_model(config, tokenizer_src, tokenizer_tgt, device)
+    pad_id = tokenizer_tgt.token_to_id('[PAD]')
+    loss_fn = torch.nn.CrossEntropyLoss(ignore_index=pad_id, label_smoothing=config['label_smoothing'], reduction='none')
+
+    dataset = train_dataloader.dataset
+    items = [dataset[i] for i in range(args.num_pairs)]
+    # pack_batch returns the pairs in this order
+    items = [items[i] for row in pack_rows(items, config['seq_len']) for i in row]
+
+    with torch.no_grad():
+        single = []
+        for item in items:
+            batch = collate_batch([item], pad_id)
+            encoder_mask, decoder_mask = make_masks(batch['src_len'].to(device), batch['tgt_len'].to(device), batch['encoder_input'].size(1), batch['decoder_input'].size(1))
+            proj_output = model(batch['encoder_input'].to(device), encoder_mask, batch['decoder_input'].to(device), decoder_mask)
+            single.append(loss_fn(proj_output[0], batch['label'][0].to(device)).sum())
+        single = torch.stack(single)
+
+        batch = pack_batch(items, pad_id, config['seq_len'])
+        src_segments, tgt_segments = batch['src_segments'].to(device), batch['tgt_segments'].to(device)
+        encoder_mask, decoder_mask, cross_mask = make_packed_masks(src_segments, tgt_segments)
+        proj_output = model(batch['encoder_input'].to(device), encoder_mask, batch['decoder_input'].to(device), decoder_mask,
+                            cross_mask=cross_mask, src_positions=batch['src_positions'].to(device), tgt_positions=batch['tgt_positions'].to(device))
+        token_loss = loss_fn(proj_output.flatten(0, 1), batch['label'].to(device).flatten()).view_as(tgt_segments)
+        # pair of every target token: the pairs of earlier rows plus its segment id in this row
+        first_pair = torch.cumsum(tgt_segments.max(dim=1).values, dim=0) - tgt_segments.max(dim=1).values
+        real = tgt_segments > 0
+        pair = (first_pair.unsqueeze(1) + tgt_segments - 1)[real]
+        packed = torch.zeros(len(items), device=device).index_add_(0, pair, token_loss[real])
+
+    padded = collate_batch(items, pad_id)
+    real_tokens = int(batch['tgt_len'].sum())
+    print(f'{len(items)} pairs: {batch["label"].size(0)} packed rows vs {len(items)} padded rows')
+    print(f'target slots holding real tokens: packed {real_tokens / batch["label"].numel():.1%}, padded {real_tokens / padded["label"].numel():.1%}')
+    print(f'per-pair loss, packed vs one by one: max abs diff {(packed - single).abs().max().item():.2e}, max rel diff {((packed - single).abs() / single.abs()).max().item():.2e}')
+
+def benchmark_speculative(config, args):
+    # acceptance rate and latency of speculative decoding against batch_greedy_decode on the same batches
+    device = get_device()
+    config['val_batch_size'] = args.batch_size
+    _, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
+    model = load_model(config, tokenizer_src, tokenizer_tgt, device)
+    draft_config = get_draft_config(config)
+    draft_config['preload'] = args.draft_preload
+    draft_model = load_model(draft_config, tokenizer_src, tokenizer_tgt, device)
+
+    count, identical, proposed, accepted = 0, 0, 0, 0
+    greedy_time, speculative_time = 0.0, 0.0
+    with torch.no_grad():
+        for batch in val_dataloader:
+            if count >= args.num_sentences:
+                break
+            source = batch['encoder_input'].to(device)
+            source_mask = padding_mask(batch['src_len'].to(device), source.size(1))
+            count += source.size(0)
+
+            greedy, seconds = timed(lambda: batch_greedy_decode(model, source, source_mask, tokenizer_tgt, config['seq_len'], device), device)
+            greedy_time += seconds
+            (tokens, batch_proposed, batch_accepted), seconds = timed(
+                lambda: speculative_decode(model, draft_model, source, source_mask, tokenizer_tgt, config['seq_len'], device, args.k), device)
+            speculative_time += seconds
+            proposed += batch_proposed
+            accepted += batch_accepted
+            identical += int((greedy == tokens).all(dim=1).sum())
+
+    print(f'{count} sentences, batch size {args.batch_size}, draft with {config["draft_layers"]} layers proposing k={args.k} tokens')
+    print(f'acceptance rate {accepted / max(proposed, 1):.1%}, identical to greedy {identical}/{count}')
+    print(f'greedy {1000 * greedy_time / count:.1f} ms/sentence, speculative {1000 * speculative_time / count:.1f} ms/sentence, speedup {greedy_time / speculative_time:.2f}x')
+
+def ddp_worker(rank, world_size, config, args, results):
+    # one data-parallel process running synthetic training steps with a fixed per-process batch
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(args.port + world_size)
+    torch.set_num_threads(max(1, args.threads // world_size))
+    setup(rank, world_size, config['dist_backend'])
+    try:
+        device = torch.device('cpu')
+        model = DistributedDataParallel(get_model(config, args.vocab_size, args.vocab_size))
+        model.train()
+        optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'], eps=1e-09)
+        loss_fn = torch.nn.CrossEntropyLoss(ignore_index=1, label_smoothing=config['label_smoothing'])
+        encoder_input, encoder_mask, decoder_input, decoder_mask, label = synthetic_batch(args.batch_size, args.seq_len, args.vocab_size, device)
+
+        def step():
+            proj_output = model(encoder_input, encoder_mask, decoder_input, decoder_mask)
+            loss = loss_fn(proj_output.view(-1, args.vocab_size), label.view(-1))
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+
+        for _ in range(args.warmup):
+            step()
+        dist.barrier()
+        _, seconds = timed(lambda: [step() for _ in range(args.steps)], device)
+        if rank == 0:
+            results.put(seconds)
+    finally:
+        cleanup()
+
+def benchmark_ddp(config, args):
+    # weak scaling over local gloo processes: the per-process batch is fixed, so perfect scaling
+    # keeps the step time constant while the tokens/s grow with the number of processes
+    context = mp.get_context('spawn')
+    results = context.SimpleQueue()
+    baseline = None
+    print(f'{"procs":>5} {"tokens/s":>10} {"efficiency":>10}')
+    for world_size in args.procs:
+        mp.spawn(ddp_worker, args=(world_size, config, args, results), nprocs=world_size)
+        seconds = results.get()
+        throughput = world_size * args.steps * args.batch_size * args.seq_len / seconds
+        if baseline is None:
+            baseline = throughput / world_size
+        print(f'{world_size:>5} {throughput:>10.0f} {throughput / (world_size * baseline):>10.1%}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the Week1 Transformer')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    decode_parser = subparsers.add_parser('decode', help='greedy vs beam search decoding throughput')
+    decode_parser.add_argument('--batch-size', type=int, default=32)
+    decode_parser.add_argument('--num-batches', type=int, default=10)
+    decode_parser.add_argument('--preload', default=None, help='epoch of the checkpoint to load')
+    decode_parser.set_defaults(func=benchmark_decode)
+
+    quantized_parser = subparsers.add_parser('quantized', help='BLEU and latency of the fp32 model vs its int8 build')
+    quantized_parser.add_argument('preload', help='epoch of the checkpoint (convert it first with quantize.py)')
+    quantized_parser.add_argument('--batch-size', type=int, default=32)
+    quantized_parser.add_argument('--num-batches', type=int, default=None, help='default: the whole validation split')
+    quantized_parser.set_defaults(func=benchmark_quantized)
+
+    train_step_parser = subparsers.add_parser('train-step', help='training steps/s and peak memory on synthetic batches')
+    train_step_parser.add_argument('--batch-size', type=int, default=8)
+    train_step_parser.add_argument('--seq-len', type=int, default=350)
+    train_step_parser.add_argument('--vocab-size', type=int, default=20000)
+    train_step_parser.add_argument('--steps', type=int, default=20)
+    train_step_parser.add_argument('--warmup', type=int, default=3)
+    train_step_parser.add_argument('--mixed-precision', action='store_true')
+    train_step_parser.set_defaults(func=benchmark_train_step)
+
+    checkpointing_parser = subparsers.add_parser('checkpointing', help='activation checkpointing memory/throughput table')
+    checkpointing_parser.add_argument('--settings', nargs='+', default=['0,0', '3,3', '2,2', '1,1'], help='encoder,decoder checkpoint_every pairs (0 = off)')
+    checkpointing_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[8, 16, 32])
+    checkpointing_parser.add_argument('--seq-len', type=int, default=350)
+    checkpointing_parser.add_argument('--vocab-size', type=int, default=20000)
+    checkpointing_parser.add_argument('--steps', type=int, default=5)
+    checkpointing_parser.add_argument('--warmup', type=int, default=1)
+    checkpointing_parser.set_defaults(func=benchmark_checkpointing)
+
+    layernorm_parser = subparsers.add_parser('layernorm', help='per-block forward/backward time of the layer norm variants')
+    layernorm_parser.add_argument('--batch-size', type=int, default=8)
+    layernorm_parser.add_argument('--seq-len', type=int, default=350)
+    layernorm_parser.add_argument('--steps', type=int, default=20)
+    layernorm_parser.add_argument('--warmup', type=int, default=3)
+    layernorm_parser.set_defaults(func=benchmark_layernorm)
+
+    tokenize_parser = subparsers.add_parser('tokenize', help='corpus tokenization wall-clock, per-sentence loop vs encode_batch')
+    tokenize_parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() or 1])
+    tokenize_parser.add_argument('--synthetic-pairs', type=int, default=0, help='tokenize this many random pairs instead of opus_books')
+    tokenize_parser.set_defaults(func=benchmark_tokenize)
+
+    packing_parser = subparsers.add_parser('packing', help='per-pair loss of packed rows vs unpacked pairs, and the padding saved')
+    packing_parser.add_argument('--num-pairs', type=int, default=64)
+    packing_parser.add_argument('--preload', default=None, help='epoch of the checkpoint to load (default: random weights)')
+    packing_parser.set_defaults(func=benchmark_packing)
+
+    speculative_parser = subparsers.add_parser('speculative', help='speculative decoding with the draft model vs greedy decoding')
+    speculative_parser.add_argument('preload', help='epoch of the full model checkpoint')
+    speculative_parser.add_argument('draft_preload', help='epoch of the draft model checkpoint (train.py --draft)')
+    speculative_parser.add_argument('--k', type=int, default=get_config()['speculative_k'])
+    speculative_parser.add_argument('--num-sentences', type=int, default=200)
+    speculative_parser.add_argument('--batch-size', type=int, default=1)
+    speculative_parser.set_defaults(func=benchmark_speculative)
+
+    ddp_parser = subparsers.add_parser('ddp', help='data-parallel scaling efficiency over local CPU processes')
+    ddp_parser.add_argument('--procs', type=int, nargs='+', default=[1, 2, 4, 8])
+    ddp_parser.add_argument('--threads', type=int, default=os.cpu_count() or 1, help='cores shared by the processes')
+    ddp_parser.add_argument('--batch-size', type=int, default=8)
+    ddp_parser.add_argument('--seq-len', type=int, default=128)
+    ddp_parser.add_argument('--vocab-size', type=int, default=20000)
+    ddp_parser.add_argument('--steps', type=int, default=10)
+    ddp_parser.add_argument('--warmup', type=int, default=2)
+    ddp_parser.add_argument('--port', type=int, default=29600)
+    ddp_parser.set_defaults(func=benchmark_ddp)
+
+    args = parser.parse_args()
+    config = get_config()
+    if getattr(args, 'preload', None) is not None:
+        config['preload'] = args.preload
+    configure_process(config)
+    args.func(config, args)
@@ -0,0 +1,132 @@
+import json
+import os
+import queue
+import random
+import threading
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from config import get_weights_file_path
+
+def to_cpu(obj):
+    # detached CPU copy of every tensor in a (nested) state dict
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+class CheckpointManager:
+    # Writes checkpoints on a background thread from a CPU snapshot, keeps the newest keep_last
+    # of them and separately the one with the lowest metric as <model_basename>best.pt. That metric
+    # is also written to <model_basename>best.json, so a restart does not have to load best.pt.
+
+    def __init__(self, config, keep_last=3):
+        self.config = config
+        self.keep_last = keep_last
+        self.model_folder = Path(config['model_folder'])
+        self.best_path = Path(get_weights_file_path(config, 'best'))
+        self.best_metric_path = self.best_path.with_suffix('.json')
+        self.best_metric = self._read_best_metric()
+
+        # at most one snapshot waits while another is written, so host memory stays bounded
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def checkpoints(self):
+        # regular checkpoints, oldest first
+        paths = [path for path in self.model_folder.glob(f"{self.config['model_basename']}*.pt") if path != self.best_path]
+        return sorted(paths, key=lambda path: path.stat().st_mtime)
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return str(checkpoints[-1]) if checkpoints else None
+
+    def save(self, tag, state, metric=None):
+        # the snapshot is taken here, so training may update the live tensors as soon as this returns
+        self._raise_error()
+        self._queue.put((tag, to_cpu(state), metric))
+
+    def wait(self):
+        # block until every queued checkpoint is on disk
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError('writing a checkpoint failed') from error
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as error:
+                self._error = error
+            finally:
+                self._queue.task_done()
+
+    def _write(self, tag, snapshot, metric):
+        path = get_weights_file_path(self.config, tag)
+        self._atomic_save(snapshot, path)
+
+        if metric is not None and (self.best_metric is None or metric < self.best_metric):
+            self.best_metric = metric
+            snapshot['metric'] = metric
+            self._atomic_save(snapshot, self.best_path)
+            self._atomic_write_json({'metric': metric}, self.best_metric_path)
+
+        for old_path in self.checkpoints()[:-self.keep_last]:
+            old_path.unlink()
+
+    def _read_best_metric(self):
+        if self.best_metric_path.exists():
+            return json.loads(self.best_metric_path.read_text())['metric']
+        if self.best_path.exists():
+            # written before best.json existed
+            return torch.load(self.best_path, map_location='cpu', weights_only=False).get('metric')
+        return None
+
+    @staticmethod
+    def _atomic_write_json(obj, path):
+        tmp_path = f'{path}.tmp'
+        Path(tmp_path).write_text(json.dumps(obj))
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _atomic_save(obj, path):
+        # a crash mid-write never leaves a truncated checkpoint behind
+        tmp_path = f'{path}.tmp'
+        torch.save(obj, tmp_path)
+        os.replace(tmp_path, path)
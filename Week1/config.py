@@ -3,21 +3,73 @@ from pathlib import Path
 def get_config():
     return {
         "batch_size": 8,
+        "accum_steps": 1,
+        "val_batch_size": 32,
+        "dynamic_padding": True,
+        "bucket_size": 100,
+        "max_tokens": None,
+        "packing": False,
+        "num_workers": 0,
+        "seed": 42,
+        "world_size": 1,
+        "dist_backend": "gloo",
         "num_epochs": 20,
         "lr": 10**-4,
+        "label_smoothing": 0.1,
+        "mixed_precision": False,
+        "loss_chunk_size": 1024,
+        "compile": False,
+        "compile_cache_dir": "compile_cache",
+        "pad_buckets": [32, 64, 128, 192, 256],
         "seq_len": 350,
         "d_model": 512,
+        "num_layers": 6,
+        "tie_embeddings": False,
+        "share_embeddings": False,
+        "layer_norm_unbiased": True,
+        "attention_backend": "math",
+        "encoder_checkpoint_every": 0,
+        "decoder_checkpoint_every": 0,
+        "beam_size": 4,
+        "length_penalty": 0.6,
+        "max_len_a": 1.2,
+        "max_len_b": 10,
+        "draft_layers": 2,
+        "draft_model_basename": "tdraft_",
+        "speculative_k": 4,
+        "speculative_max_batch": 1,
+        "translation_cache_size": 10000,
+        "encoder_cache_mb": 256,
         "lang_src": "en",
         "lang_tgt": "it",
         "model_folder": "weights",
-        "model_filename": "tmodel_",
+        "model_basename": "tmodel_",
         "preload": None,
+        "keep_checkpoints": 3,
+        "checkpoint_every": None,
         "tokenizer_file": "tokenizer_{0}.json",
-        "experiment_name": "runs/tmodel"
+        "token_cache_dir": "token_cache",
+        "tokenizer_threads": None,
+        "experiment_name": "runs/tmodel",
+        "log_every": 50
     }
 
 def get_weights_file_path(config, epoch: str):
     model_folder = config['model_folder']
     model_basename = config['model_basename']
     model_filename = f"{model_basename}{epoch}.pt"
-    return str(Path('.') / model_folder / model_filename)
\ No newline at end of file
+    return str(Path('.') / model_folder / model_filename)
+
+def get_draft_config(config):
+    # the shallow draft model for speculative decoding: same data and tokenizers, its own weights and logs
+    draft_config = dict(config)
+    draft_config['num_layers'] = config['draft_layers']
+    draft_config['model_basename'] = config['draft_model_basename']
+    draft_config['experiment_name'] = config['experiment_name'] + '_draft'
+    return draft_config
+
+def get_tokenizer_file_path(config, lang: str):
+    # with shared embeddings both languages use one joint tokenizer
+    if config['share_embeddings']:
+        lang = f"{config['lang_src']}-{config['lang_tgt']}"
+    return config['tokenizer_file'].format(lang)
@@ -1,10 +1,12 @@
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset
+from functools import lru_cache
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset, Sampler, Subset
 
 class BilingualDataset(Dataset):
 
-    def __init__(self, ds, tokenizer_src, tokenizer_tgt, src_lang, tgt_lang, seq_len):
+    def __init__(self, ds, tokenizer_src, tokenizer_tgt, src_lang, tgt_lang, seq_len, dynamic_padding=False, src_cache=None, tgt_cache=None):
         super().__init__()
 
         self.ds = ds
@@ -13,6 +15,11 @@ class BilingualDataset(Dataset):
         self.src_lang = src_lang
         self.tgt_lang = tgt_lang
         self.seq_len = seq_len
+        # with dynamic padding items come back unpadded and collate_batch pads them per batch
+        self.dynamic_padding = dynamic_padding
+        # pre-tokenized ids indexed like the full corpus (TokenCaches or lists of arrays); without them every item is encoded on the fly
+        self.src_cache = src_cache
+        self.tgt_cache = tgt_cache
         
         self.sos_token = torch.tensor([tokenizer_src.token_to_id("[SOS]")], dtype=torch.int64)
         self.eos_token = torch.tensor([tokenizer_src.token_to_id("[EOS]")], dtype=torch.int64)
@@ -21,25 +28,37 @@ class BilingualDataset(Dataset):
     def __len__(self):
         return len(self.ds)
 
+    @staticmethod
+    def token_ids(tokenizer, cache, text, corpus_index):
+        if cache is not None:
+            # read straight from the memory-mapped cache, no tokenizer work
+            return torch.from_numpy(cache[corpus_index]).to(torch.int64)
+        return torch.tensor(tokenizer.encode(text).ids, dtype=torch.int64)
+
     def __getitem__(self, index):
         src_tgt_pair = self.ds[index]
         src_text = src_tgt_pair['translation'][self.src_lang]
         tgt_text = src_tgt_pair['translation'][self.tgt_lang]
-        
-        enc_input_tokens = self.tokenizer_src.encode(src_text).ids
-        dec_input_tokens = self.tokenizer_tgt.encode(tgt_text).ids
+
+        # random_split gives a Subset, the caches are indexed by position in the full corpus
+        corpus_index = self.ds.indices[index] if isinstance(self.ds, Subset) else index
+        enc_input_tokens = self.token_ids(self.tokenizer_src, self.src_cache, src_text, corpus_index)
+        dec_input_tokens = self.token_ids(self.tokenizer_tgt, self.tgt_cache, tgt_text, corpus_index)
 
         enc_num_padding_tokens = self.seq_len - len(enc_input_tokens) - 2
         dec_num_padding_tokens = self.seq_len - len(dec_input_tokens) - 1
 
         if enc_num_padding_tokens < 0 or dec_num_padding_tokens < 0:
             raise ValueError('Sentence is too long')
+
+        if self.dynamic_padding:
+            enc_num_padding_tokens, dec_num_padding_tokens = 0, 0
         
         # Add SOS and EOS to the source text
         encoder_input = torch.cat(
             [
                 self.sos_token,
-                torch.tensor(enc_input_tokens, dtype=torch.int64),
+                enc_input_tokens,
                 self.eos_token,
                 torch.tensor([self.pad_token] * enc_num_padding_tokens, dtype=torch.int64)
             ]
@@ -49,7 +68,7 @@ class BilingualDataset(Dataset):
         decoder_input = torch.cat(
             [
                 self.sos_token,
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
+                dec_input_tokens,
                 torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64)
             ]
         )
@@ -58,26 +77,241 @@ class BilingualDataset(Dataset):
         # why only add eos token into the label?
         label = torch.cat(
             [
-                torch.tensor(dec_input_tokens, dtype=torch.int64),
+                dec_input_tokens,
                 self.eos_token,
                 torch.tensor([self.pad_token] * dec_num_padding_tokens, dtype=torch.int64)
             ]
         )
 
-        assert encoder_input.size(0) == self.seq_len
-        assert decoder_input.size(0) == self.seq_len
-        assert label.size(0) == self.seq_len
+        if not self.dynamic_padding:
+            assert encoder_input.size(0) == self.seq_len
+            assert decoder_input.size(0) == self.seq_len
+            assert label.size(0) == self.seq_len
 
+        # masks are built per batch on the device from the lengths (see make_masks)
         return {
-            "encoder_input": encoder_input, # (Seq_Len),
-            "decoder_input": decoder_input, # (Seq_Len),
-            "encoder_mask": (encoder_input != self.pad_token).unsqueeze(0).unsqueeze(0).int(), # (1, 1, Seq_Len),
-            "decoder_mask": (decoder_input != self.pad_token).unsqueeze(0).unsqueeze(0).int() & causal_mask(decoder_input.size(0)), # (1, 1, Seq_len) & (1, Seq_Len, Seq_Len)
-            "label": label, # (Seq_Len),
+            "encoder_input": encoder_input, # (Seq_Len) or (Src_Len + 2) with dynamic padding
+            "decoder_input": decoder_input, # (Seq_Len) or (Tgt_Len + 1) with dynamic padding
+            "label": label, # same size as decoder_input
+            "src_len": len(enc_input_tokens) + 2, # [SOS] + src + [EOS]
+            "tgt_len": len(dec_input_tokens) + 1, # [SOS] + tgt
             "src_text": src_text,
             "tgt_text": tgt_text
         }
 
-def causal_mask(size):
-    mask = torch.triu(torch.ones(1, size, size), diagonal=1).type(torch.int)
-    return mask == 0
\ No newline at end of file
+@lru_cache(maxsize=64)
+def causal_mask(size, device=None):
+    # (1, Seq_Len, Seq_Len), True on and below the diagonal; one shared tensor per size and device
+    return torch.tril(torch.ones(1, size, size, dtype=torch.bool, device=device))
+
+def cached_causal_mask(cached, size, device=None):
+    # (1, Size, Cached + Size): size new decoder tokens see all cached positions and each other causally
+    return torch.ones(1, size, cached + size, dtype=torch.bool, device=device).tril(diagonal=cached)
+
+def padding_mask(lengths, size):
+    # (B) --> (B, 1, 1, Seq_Len), True for real tokens
+    return (torch.arange(size, device=lengths.device) < lengths.unsqueeze(1)).unsqueeze(1).unsqueeze(1)
+
+def make_masks(src_len, tgt_len, src_size, tgt_size):
+    # build the attention masks where src_len/tgt_len live (usually already on the device)
+    encoder_mask = padding_mask(src_len, src_size) # (B, 1, 1, Src_Len)
+    decoder_mask = padding_mask(tgt_len, tgt_size) & causal_mask(tgt_size, tgt_len.device) # (B, 1, 1, Tgt_Len) & (1, Tgt_Len, Tgt_Len)
+    return encoder_mask, decoder_mask
+
+def segment_mask(query_segments, key_segments):
+    # (B, Q), (B, K) segment ids, 0 for padding --> (B, 1, Q, K): tokens of a packed row only see their
+    # own pair; padding queries see every real key, so no row of the mask is empty
+    same = (query_segments.unsqueeze(2) == key_segments.unsqueeze(1)) | (query_segments == 0).unsqueeze(2)
+    return (same & (key_segments != 0).unsqueeze(1)).unsqueeze(1)
+
+def make_packed_masks(src_segments, tgt_segments):
+    # block-diagonal versions of make_masks for pack_batch rows, plus the decoder's cross-attention mask
+    encoder_mask = segment_mask(src_segments, src_segments) # (B, 1, Src_Len, Src_Len)
+    decoder_mask = segment_mask(tgt_segments, tgt_segments) & causal_mask(tgt_segments.size(1), tgt_segments.device) # (B, 1, Tgt_Len, Tgt_Len)
+    cross_mask = segment_mask(tgt_segments, src_segments) # (B, 1, Tgt_Len, Src_Len)
+    return encoder_mask, decoder_mask, cross_mask
+
+def bucket_length(length, buckets):
+    # the smallest of the sorted buckets that fits length, the largest one if none does
+    return next((bucket for bucket in buckets if bucket >= length), buckets[-1])
+
+def pad_to(x, length, pad_id):
+    # right-pad (B, Seq_Len) to (B, length)
+    return nn.functional.pad(x, (0, length - x.size(1)), value=pad_id)
+
+def collate_batch(items, pad_id, pad_buckets=None):
+    # pad BilingualDataset items to the longest sequence in the batch; fixed-size items are left as they are
+    # with pad_buckets, lengths are further rounded up to the next bucket, so only a few shapes ever occur
+    encoder_input = pad_sequence([item['encoder_input'] for item in items], batch_first=True, padding_value=pad_id) # (B, Src_Len)
+    decoder_input = pad_sequence([item['decoder_input'] for item in items], batch_first=True, padding_value=pad_id) # (B, Tgt_Len)
+    label = pad_sequence([item['label'] for item in items], batch_first=True, padding_value=pad_id) # (B, Tgt_Len)
+    if pad_buckets:
+        encoder_input = pad_to(encoder_input, bucket_length(encoder_input.size(1), pad_buckets), pad_id)
+        tgt_len = bucket_length(decoder_input.size(1), pad_buckets)
+        decoder_input = pad_to(decoder_input, tgt_len, pad_id)
+        label = pad_to(label, tgt_len, pad_id)
+
+    return {
+        "encoder_input": encoder_input,
+        "decoder_input": decoder_input,
+        "label": label,
+        "src_len": torch.tensor([item['src_len'] for item in items], dtype=torch.int64), # (B)
+        "tgt_len": torch.tensor([item['tgt_len'] for item in items], dtype=torch.int64), # (B)
+        "src_text": [item['src_text'] for item in items],
+        "tgt_text": [item['tgt_text'] for item in items]
+    }
+
+def pack_rows(items, seq_len):
+    # first-fit decreasing: lists of item indices whose sources and targets both fit in seq_len
+    rows = [] # [src tokens, tgt tokens, indices]
+    for index in sorted(range(len(items)), key=lambda i: items[i]['src_len'] + items[i]['tgt_len'], reverse=True):
+        src_len, tgt_len = items[index]['src_len'], items[index]['tgt_len']
+        row = next((row for row in rows if row[0] + src_len <= seq_len and row[1] + tgt_len <= seq_len), None)
+        if row is None:
+            row = [0, 0, []]
+            rows.append(row)
+        row[0] += src_len
+        row[1] += tgt_len
+        row[2].append(index)
+    return [row[2] for row in rows]
+
+def pack_batch(items, pad_id, seq_len, pad_buckets=None):
+    # Collate for packing mode: several pairs share one row, each side holding the pairs back to back.
+    # Segment ids (1, 2, ... per row, 0 for padding) give the masks (make_packed_masks), positions
+    # restart at 0 for every pair. src_len/tgt_len/texts are per pair, in packed order.
+    rows = pack_rows(items, seq_len)
+    src_size = max(sum(items[i]['src_len'] for i in row) for row in rows)
+    tgt_size = max(sum(items[i]['tgt_len'] for i in row) for row in rows)
+    if pad_buckets:
+        src_size, tgt_size = bucket_length(src_size, pad_buckets), bucket_length(tgt_size, pad_buckets)
+
+    encoder_input = torch.full((len(rows), src_size), pad_id, dtype=torch.int64)
+    decoder_input = torch.full((len(rows), tgt_size), pad_id, dtype=torch.int64)
+    label = torch.full((len(rows), tgt_size), pad_id, dtype=torch.int64)
+    src_segments = torch.zeros((len(rows), src_size), dtype=torch.int64)
+    tgt_segments = torch.zeros((len(rows), tgt_size), dtype=torch.int64)
+    src_positions = torch.zeros((len(rows), src_size), dtype=torch.int64)
+    tgt_positions = torch.zeros((len(rows), tgt_size), dtype=torch.int64)
+    for r, row in enumerate(rows):
+        s, t = 0, 0
+        for segment, index in enumerate(row, start=1):
+            item = items[index]
+            n, m = item['src_len'], item['tgt_len']
+            # items may be padded to seq_len (fixed padding), only their first n/m tokens are real
+            encoder_input[r, s:s + n] = item['encoder_input'][:n]
+            decoder_input[r, t:t + m] = item['decoder_input'][:m]
+            label[r, t:t + m] = item['label'][:m]
+            src_segments[r, s:s + n] = segment
+            tgt_segments[r, t:t + m] = segment
+            src_positions[r, s:s + n] = torch.arange(n)
+            tgt_positions[r, t:t + m] = torch.arange(m)
+            s, t = s + n, t + m
+
+    packed = [items[index] for row in rows for index in row]
+    return {
+        "encoder_input": encoder_input, # (Rows, Src_Len)
+        "decoder_input": decoder_input, # (Rows, Tgt_Len)
+        "label": label, # (Rows, Tgt_Len)
+        "src_segments": src_segments, # (Rows, Src_Len)
+        "tgt_segments": tgt_segments, # (Rows, Tgt_Len)
+        "src_positions": src_positions, # (Rows, Src_Len)
+        "tgt_positions": tgt_positions, # (Rows, Tgt_Len)
+        "src_len": torch.tensor([item['src_len'] for item in packed], dtype=torch.int64), # (Pairs)
+        "tgt_len": torch.tensor([item['tgt_len'] for item in packed], dtype=torch.int64), # (Pairs)
+        "src_text": [item['src_text'] for item in packed],
+        "tgt_text": [item['tgt_text'] for item in packed]
+    }
+
+class BucketBatchSampler(Sampler):
+    # Yields batches of indices whose examples have similar lengths, so dynamic padding stays small.
+    # lengths[i] is the padded length example i needs; with max_tokens, batches are capped by
+    # longest length * number of examples instead of by batch_size. With packed (for pack_batch),
+    # max_tokens caps the sum of the lengths instead, as packed rows carry almost no padding.
+
+    def __init__(self, lengths, batch_size, max_tokens=None, bucket_size=100, shuffle=True, seed=0, num_replicas=1, rank=0, packed=False):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.packed = packed
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.seed = seed
+        # with several data-parallel processes every rank gets its own share of the batches
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch, start_batch=0):
+        # a different but reproducible order every epoch; start_batch skips batches already
+        # trained on when resuming in the middle of an epoch
+        self.epoch = epoch
+        self.start_batch = start_batch
+
+    def _split(self, indices):
+        batches, batch, longest, total = [], [], 0, 0
+        for index in indices:
+            length = self.lengths[index]
+            if self.max_tokens is not None:
+                size = total + length if self.packed else max(longest, length) * (len(batch) + 1)
+                full = size > self.max_tokens
+            else:
+                full = len(batch) == self.batch_size
+            if batch and full:
+                batches.append(batch)
+                batch, longest, total = [], 0, 0
+            batch.append(index)
+            longest = max(longest, length)
+            total += length
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _windows(self, indices):
+        # bucket_size batches worth of indices: batch_size examples each, or with packed max_tokens
+        # tokens each, as a packed batch holds as many pairs as fit rather than batch_size of them
+        if not self.packed:
+            window = self.bucket_size * self.batch_size
+            return [indices[start:start + window] for start in range(0, len(indices), window)]
+        budget = self.bucket_size * self.max_tokens
+        windows, window, total = [], [], 0
+        for index in indices:
+            if window and total + self.lengths[index] > budget:
+                windows.append(window)
+                window, total = [], 0
+            window.append(index)
+            total += self.lengths[index]
+        if window:
+            windows.append(window)
+        return windows
+
+    def batches(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+
+        # sort by length inside windows of bucket_size batches: similar lengths end up together
+        # while the window keeps the order random across the epoch
+        batches = []
+        for window in self._windows(indices):
+            batches.extend(self._split(sorted(window, key=lambda i: self.lengths[i])))
+
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=generator).tolist()
+            batches = [batches[i] for i in order]
+
+        if self.num_replicas > 1:
+            # all ranks build the same list from the same seed, then take every num_replicas-th batch;
+            # the tail is dropped so every rank runs the same number of steps
+            usable = len(batches) - len(batches) % self.num_replicas
+            batches = batches[self.rank:usable:self.num_replicas]
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches()[self.start_batch:])
+
+    def __len__(self):
+        return len(self.batches()[self.start_batch:])
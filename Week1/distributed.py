@@ -0,0 +1,63 @@
+import os
+from contextlib import contextmanager
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+def is_main_process():
+    # rank 0 alone validates, logs to TensorBoard and writes checkpoints
+    return get_rank() == 0
+
+def setup(rank, world_size, backend='gloo'):
+    # MASTER_ADDR/MASTER_PORT point every process at rank 0; torchrun sets them for multi-host runs
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+@contextmanager
+def local_main_process_first():
+    # the first process on each host builds shared files (tokenizers, token caches) while the others
+    # wait, then they all read what it wrote
+    local_rank = int(os.environ.get('LOCAL_RANK', get_rank()))
+    if is_distributed() and local_rank != 0:
+        dist.barrier()
+    yield
+    if is_distributed() and local_rank == 0:
+        dist.barrier()
+
+def _worker(rank, fn, config):
+    world_size = config['world_size']
+    # split the host's cores between the local processes instead of oversubscribing them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    setup(rank, world_size, config['dist_backend'])
+    try:
+        fn(config)
+    finally:
+        cleanup()
+
+def launch(fn, config):
+    # torchrun (one or more hosts) sets RANK/WORLD_SIZE; otherwise world_size > 1 spawns local processes
+    if 'WORLD_SIZE' in os.environ:
+        setup(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), config['dist_backend'])
+        try:
+            fn(config)
+        finally:
+            cleanup()
+    elif config['world_size'] > 1:
+        mp.spawn(_worker, args=(fn, config), nprocs=config['world_size'])
+    else:
+        fn(config)
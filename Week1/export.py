@@ -0,0 +1,137 @@
+import argparse
+import json
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+from tokenizers import Tokenizer
+
+from config import get_config, get_weights_file_path, get_tokenizer_file_path
+from dataset import padding_mask
+from model import Transformer, MultiHeadAttentionBlock
+from train import get_model
+
+class EncoderGraph(nn.Module):
+    # src ids + lengths --> the cross-attention keys/values of every decoder block, which is all the
+    # decoder needs from the encoder
+
+    def __init__(self, model: Transformer) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, src, src_len):
+        src_mask = padding_mask(src_len, src.size(1)) # (B, 1, 1, Src_Len)
+        encoder_output = self.model.encode(src, src_mask) # (B, Src_Len, d_model)
+        # the same projections MultiHeadAttentionBlock caches on the first decoding step
+        cross_keys, cross_values = [], []
+        for layer in self.model.decoder.layers:
+            attention = layer.cross_attention_block
+            # (B, Src_Len, d_model) --> (B, Src_Len, h, d_k) --> (B, h, Src_Len, d_k)
+            cross_keys.append(attention.w_k(encoder_output).view(src.size(0), src.size(1), attention.h, attention.d_k).transpose(1, 2))
+            cross_values.append(attention.w_v(encoder_output).view(src.size(0), src.size(1), attention.h, attention.d_k).transpose(1, 2))
+        return torch.stack(cross_keys), torch.stack(cross_values) # (N, B, h, Src_Len, d_k)
+
+class DecoderStepGraph(nn.Module):
+    # one incremental decoding step: the newest token, its position plus the flattened cache in,
+    # log-probabilities of the next token plus the grown self-attention cache out
+
+    def __init__(self, model: Transformer) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, token, start_pos, src_len, cross_keys, cross_values, self_keys, self_values):
+        src_mask = padding_mask(src_len, cross_keys.size(3)) # (B, 1, 1, Src_Len)
+        cache = [
+            {'self': {'key': self_keys[i], 'value': self_values[i]}, 'cross': {'key': cross_keys[i], 'value': cross_values[i]}}
+            for i in range(cross_keys.size(0))
+        ]
+        # the position is a () tensor input: decode would otherwise take it from the cache length as a
+        # Python int, which tracing bakes into the graph as a constant
+        positions = start_pos.view(1, 1).expand(token.size(0), 1) # (B, 1)
+        # encoder_output is not needed, the cross-attention keys/values come from the cache
+        out = self.model.decode(None, src_mask, token, None, cache, positions) # (B, 1, d_model)
+        log_probs = self.model.project(out[:, -1]) # (B, tgt_vocab_size)
+        new_self_keys = torch.stack([layer_cache['self']['key'] for layer_cache in cache]) # (N, B, h, Tgt_Len + 1, d_k)
+        new_self_values = torch.stack([layer_cache['self']['value'] for layer_cache in cache])
+        return log_probs, new_self_keys, new_self_values
+
+def export_model(model: Transformer, tokenizer_tgt, out_dir, export_format='onnx'):
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    model.eval()
+    # the explicit attention math exports everywhere, the fused kernel does not
+    for module in model.modules():
+        if isinstance(module, MultiHeadAttentionBlock):
+            module.backend = 'math'
+
+    attention = model.decoder.layers[0].self_attention_block
+    num_layers, heads, d_k = len(model.decoder.layers), attention.h, attention.d_k
+    # in eval mode too: torch.onnx.export restores the wrappers' training flag afterwards, which would
+    # otherwise switch model (and its dropout) back to training
+    encoder, decoder_step = EncoderGraph(model).eval(), DecoderStepGraph(model).eval()
+
+    # example inputs; every batch/length dimension is exported as dynamic
+    src = torch.full((2, 16), tokenizer_tgt.token_to_id('[PAD]'), dtype=torch.int64)
+    src_len = torch.tensor([16, 10], dtype=torch.int64)
+    token = torch.full((2, 1), tokenizer_tgt.token_to_id('[SOS]'), dtype=torch.int64)
+    start_pos = torch.tensor(3, dtype=torch.int64)
+    with torch.no_grad():
+        cross_keys, cross_values = encoder(src, src_len)
+        self_keys = torch.zeros(num_layers, 2, heads, 3, d_k)
+        self_values = torch.zeros(num_layers, 2, heads, 3, d_k)
+        decoder_inputs = (token, start_pos, src_len, cross_keys, cross_values, self_keys, self_values)
+
+        if export_format == 'onnx':
+            # the TorchScript-based exporter (dynamo=False) that dynamic_axes is for; the dynamo exporter,
+            # the default in newer torch releases, specializes the batch and cache lengths of the examples
+            cache_axes = {1: 'batch', 3: 'len'}
+            torch.onnx.export(encoder, (src, src_len), str(out_dir / 'encoder.onnx'),
+                              input_names=['src', 'src_len'], output_names=['cross_keys', 'cross_values'],
+                              dynamic_axes={'src': {0: 'batch', 1: 'src_len'}, 'src_len': {0: 'batch'},
+                                            'cross_keys': cache_axes, 'cross_values': cache_axes},
+                              opset_version=17, dynamo=False)
+            torch.onnx.export(decoder_step, decoder_inputs, str(out_dir / 'decoder_step.onnx'),
+                              input_names=['token', 'start_pos', 'src_len', 'cross_keys', 'cross_values', 'self_keys', 'self_values'],
+                              output_names=['log_probs', 'new_self_keys', 'new_self_values'],
+                              dynamic_axes={'token': {0: 'batch'}, 'src_len': {0: 'batch'},
+                                            'cross_keys': cache_axes, 'cross_values': cache_axes,
+                                            'self_keys': cache_axes, 'self_values': cache_axes,
+                                            'log_probs': {0: 'batch'}, 'new_self_keys': cache_axes, 'new_self_values': cache_axes},
+                              opset_version=17, dynamo=False)
+        elif export_format == 'torchscript':
+            torch.jit.trace(encoder, (src, src_len)).save(str(out_dir / 'encoder.pt'))
+            torch.jit.trace(decoder_step, decoder_inputs).save(str(out_dir / 'decoder_step.pt'))
+        else:
+            raise ValueError(f'unknown export format {export_format}')
+
+    # everything the runtime needs besides the graphs and the tokenizers
+    meta = {
+        'format': export_format,
+        'num_layers': num_layers,
+        'heads': heads,
+        'd_k': d_k,
+        'sos_id': tokenizer_tgt.token_to_id('[SOS]'),
+        'eos_id': tokenizer_tgt.token_to_id('[EOS]'),
+        'pad_id': tokenizer_tgt.token_to_id('[PAD]'),
+        # the positional table is a constant of the graph, decoding cannot go past it
+        'max_len': model.tgt_pos.pe.size(1),
+    }
+    with open(out_dir / 'meta.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the encoder and a single-step decoder as standalone graphs')
+    parser.add_argument('epoch', help='epoch of the checkpoint, as passed to get_weights_file_path')
+    parser.add_argument('--format', choices=['onnx', 'torchscript'], default='onnx')
+    parser.add_argument('--out', default='export')
+    args = parser.parse_args()
+
+    config = get_config()
+    tokenizer_src = Tokenizer.from_file(get_tokenizer_file_path(config, config['lang_src']))
+    tokenizer_tgt = Tokenizer.from_file(get_tokenizer_file_path(config, config['lang_tgt']))
+    model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size())
+    state = torch.load(get_weights_file_path(config, args.epoch), map_location='cpu', weights_only=False)
+    model.load_state_dict(state['model_state_dict'])
+
+    export_model(model, tokenizer_tgt, args.out, args.format)
+    print(f'Exported encoder and decoder_step ({args.format}) to {args.out}')
@@ -0,0 +1,69 @@
+import argparse
+import asyncio
+import json
+import time
+
+# Load generator for server.py. Compare e.g. a server started with --max-batch-size 1 against one
+# with --max-batch-size 32 at the same --concurrency to see the batching gain.
+
+async def http_request(host, port, method, path, payload=None):
+    reader, writer = await asyncio.open_connection(host, port)
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, content = response.partition(b'\r\n\r\n')
+    if b'transfer-encoding: chunked' in head.lower():
+        # undo the chunked framing
+        data = b''
+        while content:
+            size, _, content = content.partition(b'\r\n')
+            size = int(size, 16)
+            if size == 0:
+                break
+            data += content[:size]
+            content = content[size + 2:]
+        content = data
+    return content
+
+async def worker(host, port, sentences, latencies):
+    while sentences:
+        sentence = sentences.pop()
+        start = time.perf_counter()
+        await http_request(host, port, 'POST', '/translate', {'sentences': [sentence]})
+        latencies.append(time.perf_counter() - start)
+
+def load_sentences(args):
+    if args.sentences_file:
+        with open(args.sentences_file) as f:
+            sentences = [line.strip() for line in f if line.strip()]
+    else:
+        from datasets import load_dataset
+        ds = load_dataset('opus_books', f'{args.lang_src}-{args.lang_tgt}', split='train')
+        sentences = [item['translation'][args.lang_src] for item in ds.select(range(args.requests))]
+    return (sentences * (args.requests // len(sentences) + 1))[:args.requests]
+
+async def main(args):
+    sentences = load_sentences(args)
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(args.host, args.port, sentences, latencies) for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f'{len(latencies)} requests, concurrency {args.concurrency}: {len(latencies) / elapsed:.1f} sentences/s')
+    print(f'client latency p50 {1000 * latencies[len(latencies) // 2]:.1f} ms, p99 {1000 * latencies[min(int(0.99 * len(latencies)), len(latencies) - 1)]:.1f} ms')
+    print('server metrics:', (await http_request(args.host, args.port, 'GET', '/metrics')).decode())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send concurrent single-sentence requests to server.py')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--sentences-file', default=None, help='one sentence per line (default: opus_books source sentences)')
+    parser.add_argument('--lang-src', default='en')
+    parser.add_argument('--lang-tgt', default='it')
+    asyncio.run(main(parser.parse_args()))
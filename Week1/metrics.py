@@ -0,0 +1,93 @@
+import math
+import queue
+import threading
+import time
+from collections import Counter
+
+import torch
+
+class MetricsLogger:
+    # Sums per-step scalars on the device and only reads them back every log_every steps, with one
+    # host sync for all of them. The averages are written to TensorBoard by a background thread,
+    # so the training loop never waits on the event file.
+
+    def __init__(self, writer, log_every=50):
+        self.writer = writer
+        self.log_every = log_every
+        self._sums = {}
+        self._count = 0
+        self._last_time = time.perf_counter()
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def add(self, name, value):
+        # value may be a device tensor, it is only detached here
+        if torch.is_tensor(value):
+            value = value.detach()
+        self._sums[name] = self._sums[name] + value if name in self._sums else value
+
+    def step(self, global_step):
+        # returns the averages when this step closed a logging window, otherwise None
+        self._count += 1
+        if self._count < self.log_every:
+            return None
+
+        tensors = {name: value for name, value in self._sums.items() if torch.is_tensor(value)}
+        averages = {name: value / self._count for name, value in self._sums.items() if name not in tensors}
+        if tensors:
+            # one stack and one copy to the host for every tensor metric
+            means = torch.stack([value.float() for value in tensors.values()]) / self._count
+            averages.update(zip(tensors, means.tolist()))
+
+        now = time.perf_counter()
+        averages['steps per second'] = self._count / (now - self._last_time)
+        self._last_time = now
+
+        self._queue.put((global_step, averages))
+        self._sums = {}
+        self._count = 0
+        return averages
+
+    def log(self, name, value, global_step):
+        # host-side scalars (e.g. once per epoch) go through the same writer thread
+        self._queue.put((global_step, {name: value}))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _writer(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self.writer.flush()
+                return
+            global_step, scalars = item
+            for name, value in scalars.items():
+                self.writer.add_scalar(name, value, global_step)
+            # flush only when nothing else is waiting
+            if self._queue.empty():
+                self.writer.flush()
+
+def corpus_bleu(predictions, references, max_order=4):
+    # corpus-level BLEU-4 (uniform weights, brevity penalty) over whitespace-split sentences, in 0..100
+    matches = [0] * max_order
+    possible = [0] * max_order
+    prediction_length, reference_length = 0, 0
+    for prediction, reference in zip(predictions, references):
+        prediction, reference = prediction.split(), reference.split()
+        prediction_length += len(prediction)
+        reference_length += len(reference)
+        for n in range(1, max_order + 1):
+            prediction_ngrams = Counter(tuple(prediction[i:i + n]) for i in range(len(prediction) - n + 1))
+            reference_ngrams = Counter(tuple(reference[i:i + n]) for i in range(len(reference) - n + 1))
+            matches[n - 1] += sum((prediction_ngrams & reference_ngrams).values())
+            possible[n - 1] += max(len(prediction) - n + 1, 0)
+
+    if prediction_length == 0 or min(matches) == 0:
+        return 0.0
+    log_precision = sum(math.log(m / p) for m, p in zip(matches, possible)) / max_order
+    brevity_penalty = min(1.0, math.exp(1 - reference_length / prediction_length))
+    return 100 * brevity_penalty * math.exp(log_precision)
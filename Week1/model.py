@@ -1,6 +1,9 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import math
+import warnings
 
 class InputEmbeddings(nn.Module):
     
@@ -18,41 +21,72 @@ class PositionalEncoding(nn.Module):
     def __init__(self, d_model: int, seq_len: int, dropout: float):
         super().__init__()
         self.d_model = d_model
+        # initial size of the table, it grows when longer inputs come in
         self.seq_len = seq_len
         self.dropout = nn.Dropout(dropout)
+        # (1, seq_len, d_model) table; a buffer so it follows the model's device and dtype, but not part
+        # of the state_dict as it is recomputed from d_model
+        self.register_buffer('pe', self.sinusoids(seq_len, d_model), persistent=False)
 
-        # Create a matrix of shape (seq_len, d_model)
-        pe = torch.zeros(seq_len, d_model)
-        # Create a vector of shape (seq_len, 1)
-        position = torch.arange(0, seq_len, dtype=torch.float).unsqueeze(1)
+    @staticmethod
+    def sinusoids(length: int, d_model: int):
+        # Create a matrix of shape (length, d_model)
+        pe = torch.zeros(length, d_model)
+        # Create a vector of shape (length, 1)
+        position = torch.arange(0, length, dtype=torch.float).unsqueeze(1)
         # x = exp(log(x)), to improve numerical stability
         div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
         # Apply the sin to even and cos to odd positions
         pe[:, 0::2] = torch.sin(position * div_term)
         pe[:, 1::2] = torch.cos(position * div_term)
-
         # add batch dimension
-        pe = pe.unsqueeze(0) # (1, seq_len, d_model)
-
-        self.register_buffer('pe', pe)
-    
-    def forward(self, x):
+        return pe.unsqueeze(0) # (1, length, d_model)
+
+    def table(self, length: int):
+        # the table with at least length positions
+        if self.pe.size(1) < length:
+            # doubled when too short, so slowly growing inputs (incremental decoding) rebuild it rarely
+            size = max(length, 2 * self.pe.size(1))
+            self.register_buffer('pe', self.sinusoids(size, self.d_model).to(self.pe), persistent=False)
+        return self.pe
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the table was non-persistent still carry it as 'pe'
+        state_dict.pop(prefix + 'pe', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, start_pos: int = 0, positions=None):
         # only embed positional info up to x's actual length
-        x = x + (self.pe[:, :x.shape[1], :]).requires_grad_(False)
+        # start_pos offsets the positions when decoding incrementally with a cache
+        if positions is not None:
+            # packed rows: (B, Seq_Len) position of every token inside its own pair, never beyond Seq_Len
+            x = x + self.table(x.shape[1])[0, positions].to(x.dtype)
+        else:
+            x = x + self.table(start_pos + x.shape[1])[:, start_pos:start_pos + x.shape[1], :].to(x.dtype)
         return self.dropout(x)
 
 class LayerNormalization(nn.Module):
 
-    def __init__(self, features: int, eps: float = 10**-6) -> None:
+    def __init__(self, features: int, eps: float = 10**-6, unbiased: bool = True) -> None:
         super().__init__()
         self.eps = eps
+        # unbiased: alpha * (x - mean) / (std + eps) + bias with the n-1 std, as the model was trained so far;
+        # otherwise the standard layer norm, (x - mean) / sqrt(var + eps) with the n variance, in one fused kernel.
+        # The two are different functions (variance divisor, eps inside or outside the sqrt), so a checkpoint
+        # only gives its trained outputs with the variant it was trained with
+        self.unbiased = unbiased
         self.alpha = nn.Parameter(torch.ones(features)) # Multiplied
         self.bias = nn.Parameter(torch.ones(features)) # Added
 
     def forward(self, x):
-        mean = x.mean(dim=-1, keepdim=True)
-        std = x.std(dim=-1, keepdim=True)
-        return self.alpha * (x - mean) / (std + self.eps) + self.bias
+        # statistics in float32 even under autocast, bfloat16 is too coarse for mean/std
+        dtype = x.dtype
+        x = x.to(torch.promote_types(dtype, torch.float32))
+        if not self.unbiased:
+            return F.layer_norm(x, self.alpha.shape, self.alpha, self.bias, self.eps).to(dtype)
+        # mean and variance from a single reduction, then one scale and one fused multiply-add
+        var, mean = torch.var_mean(x, dim=-1, keepdim=True)
+        return torch.addcmul(self.bias, (x - mean) * (var.sqrt() + self.eps).reciprocal(), self.alpha).to(dtype)
 
 class FeedForwardBlock(nn.Module):
 
@@ -68,22 +102,29 @@ class FeedForwardBlock(nn.Module):
 
 class ResidualConnection(nn.Module):
 
-    def __init__(self, features: int, dropout: float) -> None:
+    def __init__(self, features: int, dropout: float, layer_norm_unbiased: bool = True) -> None:
         super().__init__()
         self.dropout = nn.Dropout(dropout)
-        self.norm = LayerNormalization(features)
+        self.norm = LayerNormalization(features, unbiased=layer_norm_unbiased)
     
-    def forward(self, x, sublayer):
-        # sublayer is a module (MHA or FFD)
-        return x + self.dropout(sublayer(self.norm(x)))
+    def forward(self, x, sublayer, *args, **kwargs):
+        # sublayer is a module (MHA or FFD), called on the normalized x plus any extra arguments
+        # (no lambdas, so the blocks can be traced and exported)
+        return x + self.dropout(sublayer(self.norm(x), *args, **kwargs))
 
 class MultiHeadAttentionBlock(nn.Module):
 
-    def __init__(self, d_model: int, h: int, dropout: float) -> None:
+    def __init__(self, d_model: int, h: int, dropout: float, backend: str = 'math') -> None:
         super().__init__()
         self.d_model = d_model
         self.h = h
         assert d_model%h == 0, "d_model is not divided by h"
+        assert backend in ('math', 'sdpa'), f"unknown attention backend {backend}"
+        # 'math' materializes the score matrix, 'sdpa' dispatches to the fused torch kernel
+        self.backend = backend
+        # attention weights are only kept on the module when asked for (e.g. to visualize them)
+        self.need_weights = False
+        self.attention_scores = None
 
         self.d_k = d_model // h
         self.w_q = nn.Linear(d_model, d_model) # Wq
@@ -107,18 +148,60 @@ class MultiHeadAttentionBlock(nn.Module):
 
         return (attention_scores@value), attention_scores
 
-
-    def forward(self, q, k, v, mask):
+    @staticmethod
+    def sdpa_attention(query, key, value, mask, dropout_p: float):
+        # the fused kernel never exposes the (Batch, h, Seq_Len, Seq_Len) scores
+        # mask: True/non-zero means the position takes part in attention; every mask built in dataset.py
+        # leaves each query row at least one key, so the boolean mask never yields an all -inf row
+        if mask is not None and mask.dtype != torch.bool:
+            mask = mask != 0
+        return F.scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=dropout_p)
+
+
+    def forward(self, q, k=None, v=None, mask=None, cache=None, static_kv=False):
+        # k and v default to q, i.e. self-attention
+        # cache is this block's dict of projected 'key'/'value' from earlier decoding steps
+        if k is None:
+            k, v = q, q
+        # static_kv means k and v never change between steps (cross-attention over the encoder output)
         query = self.w_q(q) # (Batch, Seq_Len, d_model) --> (Batch, Seq_Len, d_model)
-        key = self.w_k(k) # (Batch, Seq_Len, d_model) --> (Batch, Seq_Len, d_model)
-        value = self.w_v(v) # (Batch, Seq_Len, d_model) --> (Batch, Seq_Len, d_model)
 
          # (Batch, Seq_Len, d_model) --> (Batch, Seq_Len, h, d_k) --> (Batch, h, Seq_Len, d_k)
         query = query.view(query.shape[0], query.shape[1], self.h, self.d_k).transpose(1, 2)
-        key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1, 2)
-        value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1, 2)
 
-        x, self.attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout) # why need to mark as self.attention_score?
+        if cache is not None and static_kv and 'key' in cache:
+            # encoder output was already projected on the first step
+            key, value = cache['key'], cache['value']
+        else:
+            key = self.w_k(k) # (Batch, Seq_Len, d_model) --> (Batch, Seq_Len, d_model)
+            value = self.w_v(v) # (Batch, Seq_Len, d_model) --> (Batch, Seq_Len, d_model)
+            key = key.view(key.shape[0], key.shape[1], self.h, self.d_k).transpose(1, 2)
+            value = value.view(value.shape[0], value.shape[1], self.h, self.d_k).transpose(1, 2)
+
+            if cache is not None:
+                if not static_kv and 'key' in cache:
+                    # (Batch, h, Cached_Len, d_k) + (Batch, h, Seq_Len, d_k) --> (Batch, h, Cached_Len + Seq_Len, d_k)
+                    key = torch.cat([cache['key'], key], dim=2)
+                    value = torch.cat([cache['value'], value], dim=2)
+                cache['key'], cache['value'] = key, value
+
+        # beam search folds beams into the batch; they share the keys/values of their source sentence
+        beams = query.shape[0] // key.shape[0]
+        if beams > 1:
+            # (Batch * Beams, h, Seq_Len, d_k) --> (Batch, h, Beams * Seq_Len, d_k)
+            q_len = query.shape[2]
+            query = query.view(key.shape[0], beams, self.h, q_len, self.d_k).transpose(1, 2).reshape(key.shape[0], self.h, beams * q_len, self.d_k)
+
+        if self.backend == 'sdpa' and not self.need_weights:
+            x = MultiHeadAttentionBlock.sdpa_attention(query, key, value, mask, self.dropout.p if self.training else 0.0)
+        else:
+            x, attention_scores = MultiHeadAttentionBlock.attention(query, key, value, mask, self.dropout)
+            # holding on to the scores keeps a (Batch, h, Seq_Len, Seq_Len) tensor alive per block
+            self.attention_scores = attention_scores if self.need_weights else None
+
+        if beams > 1:
+            # (Batch, h, Beams * Seq_Len, d_k) --> (Batch * Beams, h, Seq_Len, d_k)
+            x = x.view(key.shape[0], self.h, beams, q_len, self.d_k).transpose(1, 2).reshape(-1, self.h, q_len, self.d_k)
 
         # (Batch, Seq_Len, h, d_k) --> (Batch, h, Seq_Len, d_k) --> (Batch, Seq_Len, d_model)
         x = x.transpose(1, 2).contiguous().view(x.shape[0], -1, self.h*self.d_k)
@@ -128,59 +211,72 @@ class MultiHeadAttentionBlock(nn.Module):
 
 class EncoderBlock(nn.Module):
 
-    def __init__(self, features: int, self_attention_block: MultiHeadAttentionBlock, feed_forward_block: FeedForwardBlock, dropout: float) -> None:
+    def __init__(self, features: int, self_attention_block: MultiHeadAttentionBlock, feed_forward_block: FeedForwardBlock, dropout: float, layer_norm_unbiased: bool = True) -> None:
         super().__init__()
         self.self_attention_block = self_attention_block
         self.feed_forward_block = feed_forward_block
-        self.residual_connections = nn.ModuleList([ResidualConnection(features, dropout) for _ in range(2)])
+        self.residual_connections = nn.ModuleList([ResidualConnection(features, dropout, layer_norm_unbiased) for _ in range(2)])
     
     def forward(self, x, src_mask):
         # src_mask is to avoid padding words affecting other words
-        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, src_mask)) # why need lambda?
+        x = self.residual_connections[0](x, self.self_attention_block, mask=src_mask)
         x = self.residual_connections[1](x, self.feed_forward_block)
 
         return x
 
 class Encoder(nn.Module):
 
-    def __init__(self, features: int, layers: nn.ModuleList) -> None:
+    def __init__(self, features: int, layers: nn.ModuleList, checkpoint_every: int = 0, layer_norm_unbiased: bool = True) -> None:
         super().__init__()
         self.layers = layers
-        self.norm  = LayerNormalization(features)
+        self.norm  = LayerNormalization(features, unbiased=layer_norm_unbiased)
+        # recompute every checkpoint_every-th block during backward instead of storing its activations (0 = never)
+        self.checkpoint_every = checkpoint_every
 
     
     def forward(self, x, mask):
-        for layer in self.layers:
-            x = layer(x, mask)
+        for i, layer in enumerate(self.layers):
+            if self.training and self.checkpoint_every and i % self.checkpoint_every == 0:
+                x = checkpoint(layer, x, mask, use_reentrant=False)
+            else:
+                x = layer(x, mask)
         
         return self.norm(x) # why put LN at the end?
 
 class DecoderBlock(nn.Module):
 
-    def __init__(self, features: int, self_attention_block: MultiHeadAttentionBlock, cross_attention_block: MultiHeadAttentionBlock, feed_forward_block: FeedForwardBlock, dropout: float) ->None:
+    def __init__(self, features: int, self_attention_block: MultiHeadAttentionBlock, cross_attention_block: MultiHeadAttentionBlock, feed_forward_block: FeedForwardBlock, dropout: float, layer_norm_unbiased: bool = True) ->None:
         super().__init__()
         self.self_attention_block = self_attention_block
         self.cross_attention_block = cross_attention_block
         self.feed_forward_block = feed_forward_block
-        self.residual_connections = nn.ModuleList([ResidualConnection(features, dropout) for _ in range(3)])
-
-    def forward(self, x, encoder_output, src_mask, tgt_mask):
-        x = self.residual_connections[0](x, lambda x: self.self_attention_block(x, x, x, tgt_mask))
-        x = self.residual_connections[1](x, lambda x: self.cross_attention_block(x, encoder_output, encoder_output, src_mask))
+        self.residual_connections = nn.ModuleList([ResidualConnection(features, dropout, layer_norm_unbiased) for _ in range(3)])
+
+    def forward(self, x, encoder_output, src_mask, tgt_mask, cache=None):
+        # cache holds one dict for the self-attention and one for the cross-attention of this block
+        self_cache = cache['self'] if cache is not None else None
+        cross_cache = cache['cross'] if cache is not None else None
+        x = self.residual_connections[0](x, self.self_attention_block, mask=tgt_mask, cache=self_cache)
+        x = self.residual_connections[1](x, self.cross_attention_block, encoder_output, encoder_output, src_mask, cache=cross_cache, static_kv=True)
         x = self.residual_connections[2](x, self.feed_forward_block)
 
         return x
 
 class Decoder(nn.Module):
 
-    def __init__(self, features: int, layers: nn.ModuleList) -> None:
+    def __init__(self, features: int, layers: nn.ModuleList, checkpoint_every: int = 0, layer_norm_unbiased: bool = True) -> None:
         super().__init__()
         self.layers = layers
-        self.norm = LayerNormalization(features)
+        self.norm = LayerNormalization(features, unbiased=layer_norm_unbiased)
+        # recompute every checkpoint_every-th block during backward instead of storing its activations (0 = never)
+        self.checkpoint_every = checkpoint_every
     
-    def forward(self, x, encoder_output, src_mask, tgt_mask):
-        for layer in self.layers:
-            x = layer(x, encoder_output, src_mask, tgt_mask)
+    def forward(self, x, encoder_output, src_mask, tgt_mask, cache=None):
+        for i, layer in enumerate(self.layers):
+            if cache is None and self.training and self.checkpoint_every and i % self.checkpoint_every == 0:
+                x = checkpoint(layer, x, encoder_output, src_mask, tgt_mask, use_reentrant=False)
+            else:
+                x = layer(x, encoder_output, src_mask, tgt_mask, cache[i] if cache is not None else None)
         
         return self.norm(x)
 
@@ -192,7 +288,23 @@ class ProjectionLayer(nn.Module):
 
     def forward(self, x):
         # (batch, seq_len, d_model) --> (batch, seq_len, vocab_size)
-        return torch.log_softmax(self.proj(x))
+        # log_softmax in float32, also under autocast
+        return torch.log_softmax(self.proj(x).float(), dim=-1)
+
+    def _chunk_loss(self, x, label, ignore_index, label_smoothing):
+        # (chunk, d_model) --> (chunk, vocab_size) logits --> summed cross-entropy, softmax applied once
+        return F.cross_entropy(self.proj(x).float(), label, ignore_index=ignore_index, label_smoothing=label_smoothing, reduction='sum')
+
+    def chunked_loss(self, x, label, ignore_index: int = -100, label_smoothing: float = 0.0, chunk_size: int = 1024):
+        # label-smoothed cross-entropy summed over all positions, computed chunk_size positions at a time
+        # every chunk is checkpointed, so backward recomputes its logits as well and the full
+        # (batch, seq_len, vocab_size) tensor never exists
+        x = x.reshape(-1, x.size(-1)) # (batch * seq_len, d_model)
+        label = label.reshape(-1) # (batch * seq_len)
+        loss = 0
+        for start in range(0, x.size(0), chunk_size):
+            loss = loss + checkpoint(self._chunk_loss, x[start:start + chunk_size], label[start:start + chunk_size], ignore_index, label_smoothing, use_reentrant=False)
+        return loss
 
 class Transformer(nn.Module):
 
@@ -206,23 +318,97 @@ class Transformer(nn.Module):
         self.tgt_pos = tgt_pos
         self.projection_layer = projection_layer
 
-    def encode(self, src, src_mask):
+    def tied_weights(self):
+        # groups of state_dict keys that are one shared parameter in this model
+        groups = {}
+        for name, param in self.named_parameters(remove_duplicate=False):
+            groups.setdefault(id(param), []).append(name)
+        return [names for names in groups.values() if len(names) > 1]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints from a tied model hold the shared matrix under every key, so an untied model
+        # loads them as is. For an untied checkpoint in a tied model the first key in module order
+        # (the embedding, not the projection) wins, so that all keys of a group load the same values;
+        # the trained values of the other keys are lost, hence the warning.
+        for names in self.tied_weights():
+            present = [prefix + name for name in names if prefix + name in state_dict]
+            if present:
+                dropped = [name for name in present[1:] if not torch.equal(state_dict[name], state_dict[present[0]])]
+                if dropped:
+                    warnings.warn(f"loading an untied checkpoint into a tied model: {', '.join(dropped)} replaced by {present[0]}")
+                for name in names:
+                    state_dict[prefix + name] = state_dict[present[0]]
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def forward(self, src, src_mask, tgt, tgt_mask, label=None, ignore_index: int = -100, label_smoothing: float = 0.0, loss_chunk_size: int = 1024,
+                cross_mask=None, src_positions=None, tgt_positions=None):
+        # the full training pass in one call, so wrappers such as DistributedDataParallel see it
+        # packed rows (see pack_batch) pass their own cross-attention mask and per-pair positions
+        encoder_output = self.encode(src, src_mask, src_positions) # (B, Seq_Len, d_model)
+        decoder_output = self.decode(encoder_output, src_mask if cross_mask is None else cross_mask, tgt, tgt_mask, positions=tgt_positions) # (B, Seq_Len, d_model)
+        if label is None:
+            return self.project(decoder_output) # (B, Seq_Len, tgt_vocab_size)
+        # with labels: the summed loss, without materializing the log-probabilities
+        return self.projection_layer.chunked_loss(decoder_output, label, ignore_index, label_smoothing, loss_chunk_size)
+
+    def encode(self, src, src_mask, positions=None):
         src = self.src_embed(src)
-        src = self.src_pos(src)
+        src = self.src_pos(src, positions=positions)
         return self.encoder(src, src_mask)
     
-    def decode(self, encoder_output, src_mask, tgt, tgt_mask):
+    def decode(self, encoder_output, src_mask, tgt, tgt_mask, cache=None, positions=None):
+        # with a cache from init_cache, tgt only needs the tokens not seen by earlier calls
+        start_pos = self.cache_len(cache)
         tgt = self.tgt_embed(tgt)
-        tgt = self.tgt_pos(tgt)
-        return self.decoder(tgt, encoder_output, src_mask, tgt_mask)
+        tgt = self.tgt_pos(tgt, start_pos, positions)
+        return self.decoder(tgt, encoder_output, src_mask, tgt_mask, cache)
+
+    def init_cache(self):
+        # one key/value cache per decoder block, filled in by decode
+        return [{'self': {}, 'cross': {}} for _ in self.decoder.layers]
+
+    @staticmethod
+    def cache_len(cache):
+        # number of target positions already stored in the cache
+        if cache is None or 'key' not in cache[0]['self']:
+            return 0
+        return cache[0]['self']['key'].size(2)
+
+    @staticmethod
+    def reorder_cache(cache, index, self_only=False):
+        # keep only the batch rows listed in index, e.g. to drop sequences that already finished
+        # self_only leaves the cross-attention cache alone (beam search keeps it once per source)
+        for layer_cache in cache:
+            for kind, attention_cache in layer_cache.items():
+                if self_only and kind == 'cross':
+                    continue
+                for name, tensor in attention_cache.items():
+                    attention_cache[name] = tensor.index_select(0, index)
+
+    @staticmethod
+    def trim_cache(cache, length):
+        # keep the first length target positions of the self-attention cache, e.g. to drop rejected draft tokens
+        for layer_cache in cache:
+            for name, tensor in layer_cache['self'].items():
+                layer_cache['self'][name] = tensor[:, :, :length]
 
     def project(self, x):
         return self.projection_layer(x)
 
-def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int, tgt_seq_len: int, d_model: int = 512, N: int = 6, h: int = 8, dropout: float = 0.1, d_ff: int = 2048) -> Transformer:
+    def keep_attention_scores(self, keep: bool = True):
+        # store attention_scores on every attention block during the next forward passes
+        for module in self.modules():
+            if isinstance(module, MultiHeadAttentionBlock):
+                module.need_weights = keep
+
+def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int, tgt_seq_len: int, d_model: int = 512, N: int = 6, h: int = 8, dropout: float = 0.1, d_ff: int = 2048, attention_backend: str = 'math', encoder_checkpoint_every: int = 0, decoder_checkpoint_every: int = 0, tie_embeddings: bool = False, share_embeddings: bool = False, layer_norm_unbiased: bool = True) -> Transformer:
     # Create the embedding layers
     src_embed = InputEmbeddings(d_model, src_vocab_size)
     tgt_embed = InputEmbeddings(d_model, tgt_vocab_size)
+    if share_embeddings:
+        # one table for both languages, needs a joint vocabulary
+        assert src_vocab_size == tgt_vocab_size, "share_embeddings needs a joint source/target vocabulary"
+        tgt_embed.embedding.weight = src_embed.embedding.weight
 
     # Create the positional encoding layers
     src_pos = PositionalEncoding(d_model, src_seq_len, dropout)
@@ -231,26 +417,29 @@ def build_transformer(src_vocab_size: int, tgt_vocab_size: int, src_seq_len: int
     # Create the encoder blocks
     encoder_blocks = []
     for _ in range(N):
-        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
+        encoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend)
         feedforwardblock = FeedForwardBlock(d_model, d_ff, dropout)
-        encoder_block = EncoderBlock(d_model, encoder_self_attention_block, feedforwardblock, dropout)
+        encoder_block = EncoderBlock(d_model, encoder_self_attention_block, feedforwardblock, dropout, layer_norm_unbiased)
         encoder_blocks.append(encoder_block)
     
     # Create the decoder blocks
     decoder_blocks = []
     for _ in range(N):
-        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
-        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout)
+        decoder_self_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend)
+        decoder_cross_attention_block = MultiHeadAttentionBlock(d_model, h, dropout, attention_backend)
         feed_forward_block = FeedForwardBlock(d_model, d_ff, dropout)
-        decoder_block = DecoderBlock(d_model, decoder_self_attention_block, decoder_cross_attention_block, feed_forward_block, dropout)
+        decoder_block = DecoderBlock(d_model, decoder_self_attention_block, decoder_cross_attention_block, feed_forward_block, dropout, layer_norm_unbiased)
         decoder_blocks.append(decoder_block)
     
     # Create the encoder and decoder
-    encoder = Encoder(d_model, nn.ModuleList(encoder_blocks))
-    decoder = Decoder(d_model, nn.ModuleList(decoder_blocks))
+    encoder = Encoder(d_model, nn.ModuleList(encoder_blocks), encoder_checkpoint_every, layer_norm_unbiased)
+    decoder = Decoder(d_model, nn.ModuleList(decoder_blocks), decoder_checkpoint_every, layer_norm_unbiased)
 
     # Create the projection layer
     projection_layer = ProjectionLayer(d_model, tgt_vocab_size)
+    if tie_embeddings or share_embeddings:
+        # the projection reuses the target embedding matrix, (vocab_size, d_model) in both
+        projection_layer.proj.weight = tgt_embed.embedding.weight
 
     # Create the transformer
     transformer = Transformer(encoder, decoder, src_embed, tgt_embed, src_pos, tgt_pos, projection_layer)
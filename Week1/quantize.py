@@ -0,0 +1,52 @@
+import argparse
+from pathlib import Path
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+from tokenizers import Tokenizer
+
+from config import get_config, get_weights_file_path, get_tokenizer_file_path
+from model import Transformer
+from train import get_model
+
+def get_quantized_file_path(config, epoch: str):
+    # next to the fp32 checkpoint, but not a *.pt file so checkpoint retention leaves it alone
+    return str(Path(get_weights_file_path(config, epoch)).with_suffix('.int8'))
+
+def quantize_model(model: Transformer) -> Transformer:
+    # int8 weights with activations quantized on the fly; covers every nn.Linear, i.e. w_q/w_k/w_v/w_o
+    # of the attention blocks, both layers of the feed-forward blocks and the projection layer
+    model.eval()
+    return quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+def build_model(config) -> Transformer:
+    # an fp32 model of the configured architecture with the vocabulary sizes of the saved tokenizers
+    tokenizer_src = Tokenizer.from_file(get_tokenizer_file_path(config, config['lang_src']))
+    tokenizer_tgt = Tokenizer.from_file(get_tokenizer_file_path(config, config['lang_tgt']))
+    return get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size())
+
+def convert_checkpoint(config, epoch: str):
+    model = build_model(config)
+    state = torch.load(get_weights_file_path(config, epoch), map_location='cpu', weights_only=False)
+    model.load_state_dict(state['model_state_dict'])
+
+    # only the state_dict with the packed int8 weights is saved, the module is rebuilt from the code on load
+    quantized_filename = get_quantized_file_path(config, epoch)
+    torch.save(quantize_model(model).state_dict(), quantized_filename)
+    return quantized_filename
+
+def load_quantized_model(config, epoch: str) -> Transformer:
+    # a drop-in replacement for the fp32 model in greedy_decode/batch_greedy_decode/beam_search_decode (CPU only);
+    # quantizing the freshly built model gives the module structure the saved int8 weights load into
+    model = quantize_model(build_model(config))
+    model.load_state_dict(torch.load(get_quantized_file_path(config, epoch), map_location='cpu', weights_only=True))
+    return model.eval()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a trained checkpoint into a dynamically int8-quantized model')
+    parser.add_argument('epoch', help='epoch of the checkpoint, as passed to get_weights_file_path')
+    args = parser.parse_args()
+
+    quantized_filename = convert_checkpoint(get_config(), args.epoch)
+    print(f'Quantized model saved to {quantized_filename}')
@@ -0,0 +1,87 @@
+import json
+from pathlib import Path
+
+import numpy as np
+from tokenizers import Tokenizer
+
+# Greedy translation with the graphs written by export.py. This file deliberately imports nothing
+# from the training code: onnxruntime for ONNX exports, plain torch.jit for TorchScript exports.
+
+class ExportedTranslator:
+
+    def __init__(self, export_dir, tokenizer_src_file, tokenizer_tgt_file, max_len=350):
+        export_dir = Path(export_dir)
+        with open(export_dir / 'meta.json') as f:
+            self.meta = json.load(f)
+        self.tokenizer_src = Tokenizer.from_file(str(tokenizer_src_file))
+        self.tokenizer_tgt = Tokenizer.from_file(str(tokenizer_tgt_file))
+        self.max_len = min(max_len, self.meta['max_len'])
+
+        if self.meta['format'] == 'onnx':
+            import onnxruntime
+            encoder = onnxruntime.InferenceSession(str(export_dir / 'encoder.onnx'))
+            decoder_step = onnxruntime.InferenceSession(str(export_dir / 'decoder_step.onnx'))
+            self._encode = lambda src, src_len: encoder.run(None, {'src': src, 'src_len': src_len})
+            self._decode_step = lambda *inputs: decoder_step.run(None, dict(zip(
+                ['token', 'start_pos', 'src_len', 'cross_keys', 'cross_values', 'self_keys', 'self_values'], inputs)))
+        else:
+            import torch
+            encoder = torch.jit.load(str(export_dir / 'encoder.pt'))
+            decoder_step = torch.jit.load(str(export_dir / 'decoder_step.pt'))
+
+            def run(graph, *inputs):
+                with torch.no_grad():
+                    return [out.numpy() for out in graph(*(torch.from_numpy(x) for x in inputs))]
+            self._encode = lambda src, src_len: run(encoder, src, src_len)
+            self._decode_step = lambda *inputs: run(decoder_step, *inputs)
+
+    def _source_batch(self, sentences):
+        # [SOS] ids [EOS], right-padded with [PAD] to the longest sentence
+        sos_id = self.tokenizer_src.token_to_id('[SOS]')
+        eos_id = self.tokenizer_src.token_to_id('[EOS]')
+        pad_id = self.tokenizer_src.token_to_id('[PAD]')
+        ids = [[sos_id] + encoding.ids + [eos_id] for encoding in self.tokenizer_src.encode_batch(sentences)]
+        src = np.full((len(ids), max(len(row) for row in ids)), pad_id, dtype=np.int64)
+        for i, row in enumerate(ids):
+            src[i, :len(row)] = row
+        return src, np.array([len(row) for row in ids], dtype=np.int64)
+
+    def translate(self, sentences):
+        sos_id, eos_id = self.meta['sos_id'], self.meta['eos_id']
+        src, src_len = self._source_batch(sentences)
+        batch_size = src.shape[0]
+        cross_keys, cross_values = self._encode(src, src_len)
+
+        shape = (self.meta['num_layers'], batch_size, self.meta['heads'], 0, self.meta['d_k'])
+        self_keys = np.zeros(shape, dtype=cross_keys.dtype)
+        self_values = np.zeros(shape, dtype=cross_values.dtype)
+        token = np.full((batch_size, 1), sos_id, dtype=np.int64)
+        outputs = [[] for _ in range(batch_size)]
+        finished = np.zeros(batch_size, dtype=bool)
+
+        for step in range(self.max_len - 1):
+            start_pos = np.array(step, dtype=np.int64)
+            log_probs, self_keys, self_values = self._decode_step(token, start_pos, src_len, cross_keys, cross_values, self_keys, self_values)
+            next_word = log_probs.argmax(axis=-1)
+            for i in np.flatnonzero(~finished):
+                outputs[i].append(int(next_word[i]))
+            finished |= next_word == eos_id
+            if finished.all():
+                break
+            token = next_word.reshape(batch_size, 1).astype(np.int64)
+
+        return [self.tokenizer_tgt.decode(ids) for ids in outputs]
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Translate sentences with an exported model')
+    parser.add_argument('export_dir')
+    parser.add_argument('tokenizer_src')
+    parser.add_argument('tokenizer_tgt')
+    parser.add_argument('sentences', nargs='+')
+    args = parser.parse_args()
+
+    translator = ExportedTranslator(args.export_dir, args.tokenizer_src, args.tokenizer_tgt)
+    for sentence, translation in zip(args.sentences, translator.translate(args.sentences)):
+        print(f'{sentence} --> {translation}')
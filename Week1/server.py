@@ -0,0 +1,256 @@
+import argparse
+import asyncio
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from tokenizers import Tokenizer
+
+from config import get_config, get_draft_config, get_weights_file_path, get_tokenizer_file_path
+from dataset import padding_mask
+from quantize import load_quantized_model
+from train import get_model, batch_greedy_decode, speculative_decode
+from translation_cache import TranslationCache
+
+class Translator:
+    # the model and both tokenizers, loaded once for the lifetime of the server
+
+    def __init__(self, config, epoch, quantized=False, draft_epoch=None):
+        self.config = config
+        self.tokenizer_src = Tokenizer.from_file(get_tokenizer_file_path(config, config['lang_src']))
+        self.tokenizer_tgt = Tokenizer.from_file(get_tokenizer_file_path(config, config['lang_tgt']))
+        # int8 models only run on CPU
+        self.device = torch.device('cuda' if torch.cuda.is_available() and not quantized else 'cpu')
+        self.model = self.load(config, epoch, quantized)
+        # with a draft model, batches of up to speculative_max_batch sentences use speculative decoding
+        self.draft_model = self.load(get_draft_config(config), draft_epoch, quantized) if draft_epoch is not None else None
+        self.cache = TranslationCache(config['translation_cache_size'], config['encoder_cache_mb'])
+
+    def load(self, config, epoch, quantized):
+        if quantized:
+            return load_quantized_model(config, epoch)
+        model = get_model(config, self.tokenizer_src.get_vocab_size(), self.tokenizer_tgt.get_vocab_size()).to(self.device)
+        state = torch.load(get_weights_file_path(config, epoch), map_location=self.device, weights_only=False)
+        model.load_state_dict(state['model_state_dict'])
+        model.eval()
+        return model
+
+    def translate(self, sentences):
+        # cached translations first, then one batched encode + greedy decode for the rest
+        sos_id = self.tokenizer_src.token_to_id('[SOS]')
+        eos_id = self.tokenizer_src.token_to_id('[EOS]')
+
+        # [SOS] ids [EOS]; the positional encodings grow with the input, so sentences longer than seq_len are translated whole
+        ids = [[sos_id] + encoding.ids + [eos_id] for encoding in self.tokenizer_src.encode_batch(sentences)]
+        keys = [self.cache.key(row) for row in ids]
+        # entries are keyed by the decoder that produced them: speculative decoding checks several tokens per
+        # pass, whose rounding differs from one-token steps, so near ties may come out differently than greedy
+        mode = self.decoding_mode(len(ids))
+        translations = [self.cache.translations.get((mode, key)) for key in keys]
+        missing = [i for i, translation in enumerate(translations) if translation is None]
+        if missing:
+            for i, translation in zip(missing, self.decode([ids[i] for i in missing], [keys[i] for i in missing], mode)):
+                translations[i] = translation
+                self.cache.translations.put((mode, keys[i]), translation)
+        return translations
+
+    def decoding_mode(self, batch_size):
+        # a batch advances by the shortest draft prefix any of its rows accepts, so the draft model
+        # saves the most on small batches (BENCHMARKS.md)
+        if self.draft_model is not None and batch_size <= self.config['speculative_max_batch']:
+            return 'speculative'
+        return 'greedy'
+
+    def decode(self, ids, keys, mode):
+        pad_id = self.tokenizer_src.token_to_id('[PAD]')
+        seq_len = self.config['seq_len']
+
+        # right-padded to the longest sentence of the batch
+        lengths = [len(row) for row in ids]
+        src = torch.full((len(ids), max(lengths)), pad_id, dtype=torch.int64)
+        for i, row in enumerate(ids):
+            src[i, :len(row)] = torch.tensor(row, dtype=torch.int64)
+
+        # room for translations of long inputs, as in beam_search_decode's length limit
+        max_len = max(seq_len, int(self.config['max_len_a'] * src.size(1) + self.config['max_len_b']))
+        src = src.to(self.device)
+        src_mask = padding_mask(torch.tensor(lengths, device=self.device), src.size(1))
+        with torch.no_grad():
+            # encoder outputs of recently seen sources are reused
+            encoder_output = self.cache.encode(self.model, src, src_mask, lengths, keys)
+            if mode == 'speculative':
+                draft_encoder_output = self.cache.encode(self.draft_model, src, src_mask, lengths, keys, draft=True)
+                model_out, _, _ = speculative_decode(self.model, self.draft_model, src, src_mask, self.tokenizer_tgt, max_len, self.device,
+                                                     self.config['speculative_k'], encoder_output, draft_encoder_output)
+            else:
+                model_out = batch_greedy_decode(self.model, src, src_mask, self.tokenizer_tgt, max_len, self.device, encoder_output)
+        return [self.tokenizer_tgt.decode(row) for row in model_out.tolist()]
+
+class ServerStats:
+    # counters and a window of recent per-sentence latencies for /metrics
+
+    def __init__(self, window=10000):
+        self.start = time.perf_counter()
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.sentences = 0
+        self.batches = 0
+
+    def snapshot(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return 1000 * latencies[min(int(p * len(latencies)), len(latencies) - 1)] if latencies else None
+
+        elapsed = time.perf_counter() - self.start
+        return {
+            'requests': self.requests,
+            'sentences': self.sentences,
+            'batches': self.batches,
+            'mean_batch_size': self.sentences / self.batches if self.batches else None,
+            'p50_ms': percentile(0.50),
+            'p99_ms': percentile(0.99),
+            'sentences_per_second': self.sentences / elapsed,
+        }
+
+class BatchingServer:
+    # Queues single sentences from all connections and translates them in batches: a batch is closed
+    # when max_batch_size sentences are waiting or the oldest has waited max_wait_ms. Everything
+    # collected is sorted by length first, so each batch pads as little as possible.
+
+    def __init__(self, translator, max_batch_size=32, max_wait_ms=10.0):
+        self.translator = translator
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = ServerStats()
+        # the model runs one batch at a time, off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+
+    async def translate(self, sentence):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((sentence, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        # wait for the first sentence, then keep collecting until the batch is full or the budget is spent
+        pending = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(pending) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # sentences that arrived meanwhile ride along, grouped by length with the rest
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        # whitespace words are a cheap stand-in for the token count
+        pending.sort(key=lambda item: len(item[0].split()))
+        return [pending[i:i + self.max_batch_size] for i in range(0, len(pending), self.max_batch_size)]
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            for batch in await self._collect():
+                sentences = [sentence for sentence, _, _ in batch]
+                try:
+                    translations = await loop.run_in_executor(self.executor, self.translator.translate, sentences)
+                except Exception as error:
+                    for _, future, _ in batch:
+                        if not future.done():
+                            future.set_exception(error)
+                    continue
+
+                now = time.perf_counter()
+                self.stats.batches += 1
+                self.stats.sentences += len(batch)
+                for (_, future, enqueued), translation in zip(batch, translations):
+                    self.stats.latencies.append(now - enqueued)
+                    if not future.done():
+                        future.set_result(translation)
+
+    async def handle(self, reader, writer):
+        # minimal HTTP/1.1: POST /translate {"sentences": [...]} streams one JSON line per sentence
+        # as soon as its batch is done; GET /metrics returns the counters and the cache statistics
+        try:
+            method, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            if method == 'GET' and path == '/metrics':
+                await self._send(writer, 200, json.dumps({**self.stats.snapshot(), 'cache': self.translator.cache.stats()}).encode())
+            elif method == 'POST' and path == '/translate':
+                sentences = json.loads(body)['sentences']
+                if not isinstance(sentences, list) or not all(isinstance(s, str) for s in sentences):
+                    raise ValueError('sentences must be a list of strings')
+                self.stats.requests += 1
+                await self._stream(writer, sentences)
+            else:
+                await self._send(writer, 404, b'{"error": "not found"}')
+        except (ValueError, KeyError, TypeError) as error:
+            # TypeError: a JSON body that is not an object, e.g. a bare list
+            await self._send(writer, 400, json.dumps({'error': str(error)}).encode())
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _stream(self, writer, sentences):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+
+        async def indexed(index, sentence):
+            # the status line is already sent, so a failed batch is reported per sentence and the
+            # response still ends with the terminating chunk
+            try:
+                return {'index': index, 'translation': await self.translate(sentence)}
+            except Exception as error:
+                return {'index': index, 'error': str(error)}
+
+        for result in asyncio.as_completed([indexed(i, sentence) for i, sentence in enumerate(sentences)]):
+            line = (json.dumps(await result) + '\n').encode()
+            writer.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+            await writer.drain()
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+    @staticmethod
+    async def _send(writer, status, body):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+
+    async def serve(self, host, port):
+        self.queue = asyncio.Queue()
+        batcher = asyncio.create_task(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f'Serving on http://{host}:{port} (max batch size {self.max_batch_size}, max wait {1000 * self.max_wait:.0f} ms)')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Translation server with dynamic request batching')
+    parser.add_argument('epoch', help='epoch of the checkpoint, as passed to get_weights_file_path')
+    parser.add_argument('--int8', action='store_true', help='serve the quantized build from quantize.py')
+    parser.add_argument('--draft-epoch', default=None, help='epoch of a draft model (train.py --draft) for speculative decoding of batches up to speculative_max_batch')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=10.0)
+    args = parser.parse_args()
+
+    translator = Translator(get_config(), args.epoch, quantized=args.int8, draft_epoch=args.draft_epoch)
+    asyncio.run(BatchingServer(translator, args.max_batch_size, args.max_wait_ms).serve(args.host, args.port))
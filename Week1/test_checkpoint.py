@@ -0,0 +1,31 @@
+import torch
+
+from checkpoint import CheckpointManager
+
+def make_manager(tmp_path, monkeypatch, keep_last=2):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'weights').mkdir()
+    return CheckpointManager({'model_folder': 'weights', 'model_basename': 'tmodel_'}, keep_last)
+
+def test_latest_is_none_without_checkpoints(tmp_path, monkeypatch):
+    checkpoints = make_manager(tmp_path, monkeypatch)
+    assert checkpoints.latest() is None
+    checkpoints.close()
+
+def test_keeps_last_and_best(tmp_path, monkeypatch):
+    checkpoints = make_manager(tmp_path, monkeypatch)
+    for epoch, metric in enumerate([3.0, 1.0, 2.0, 4.0]):
+        checkpoints.save(f'{epoch:02d}', {'epoch': epoch}, metric=metric)
+        checkpoints.wait()
+    checkpoints.close()
+
+    assert [path.name for path in checkpoints.checkpoints()] == ['tmodel_02.pt', 'tmodel_03.pt']
+    assert checkpoints.latest().endswith('tmodel_03.pt')
+    best = torch.load(tmp_path / 'weights' / 'tmodel_best.pt', weights_only=False)
+    assert best == {'epoch': 1, 'metric': 1.0}
+
+    # a new manager picks up the best metric from best.json without loading best.pt
+    monkeypatch.setattr(torch, 'load', None)
+    reopened = CheckpointManager({'model_folder': 'weights', 'model_basename': 'tmodel_'})
+    assert reopened.best_metric == 1.0
+    reopened.close()
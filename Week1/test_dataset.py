@@ -0,0 +1,94 @@
+import torch
+import torch.nn.functional as F
+
+from dataset import BucketBatchSampler, collate_batch, make_masks, make_packed_masks, pack_batch, pack_rows, segment_mask
+from model import build_transformer
+
+def make_items(lengths, vocab_size=20, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    items = []
+    for src_len, tgt_len in lengths:
+        items.append({
+            'encoder_input': torch.randint(1, vocab_size, (src_len,), generator=generator),
+            'decoder_input': torch.randint(1, vocab_size, (tgt_len,), generator=generator),
+            'label': torch.randint(1, vocab_size, (tgt_len,), generator=generator),
+            'src_len': src_len,
+            'tgt_len': tgt_len,
+            'src_text': '',
+            'tgt_text': '',
+        })
+    return items
+
+def test_sampler_shards_cover_every_batch_once():
+    lengths = [i % 17 + 1 for i in range(200)]
+    full = BucketBatchSampler(lengths, 8, bucket_size=4, seed=3).batches()
+    shards = [BucketBatchSampler(lengths, 8, bucket_size=4, seed=3, num_replicas=3, rank=rank).batches() for rank in range(3)]
+    assert len({len(shard) for shard in shards}) == 1
+    seen = sorted(tuple(batch) for shard in shards for batch in shard)
+    assert seen == sorted(tuple(batch) for batch in full[:len(full) - len(full) % 3])
+
+def test_sampler_resumes_mid_epoch():
+    lengths = [i % 17 + 1 for i in range(200)]
+    sampler = BucketBatchSampler(lengths, 8, bucket_size=4, seed=3)
+    sampler.set_epoch(2)
+    epoch = list(sampler)
+    sampler.set_epoch(2, start_batch=5)
+    assert list(sampler) == epoch[5:]
+    sampler.set_epoch(3)
+    assert list(sampler) != epoch
+
+def test_packed_sampler_fills_the_token_budget():
+    # short pairs: a packed batch holds far more than batch_size of them
+    lengths = [4] * 400
+    batches = BucketBatchSampler(lengths, 4, 4 * 32, 1, seed=0, packed=True).batches()
+    assert all(sum(lengths[i] for i in batch) <= 4 * 32 for batch in batches)
+    assert max(len(batch) for batch in batches) == 32
+    assert sorted(i for batch in batches for i in batch) == list(range(400))
+
+def test_pack_rows_fits_both_sides():
+    items = make_items([(5, 3), (2, 6), (4, 4), (1, 1), (6, 2)])
+    rows = pack_rows(items, 8)
+    assert sorted(i for row in rows for i in row) == list(range(len(items)))
+    for row in rows:
+        assert sum(items[i]['src_len'] for i in row) <= 8
+        assert sum(items[i]['tgt_len'] for i in row) <= 8
+
+def test_segment_mask():
+    segments = torch.tensor([[1, 1, 2, 0]])
+    expected = torch.tensor([[
+        [True, True, False, False],
+        [True, True, False, False],
+        [False, False, True, False],
+        [True, True, True, False],
+    ]])
+    assert torch.equal(segment_mask(segments, segments)[:, 0], expected)
+
+def test_packed_loss_matches_unpacked():
+    torch.manual_seed(0)
+    model = build_transformer(20, 20, 16, 16, d_model=16, N=2, h=2, d_ff=32).eval()
+    items = make_items([(5, 3), (2, 6), (4, 4), (1, 1), (6, 2), (3, 5)])
+
+    batch = collate_batch(items, pad_id=0)
+    encoder_mask, decoder_mask = make_masks(batch['src_len'], batch['tgt_len'], batch['encoder_input'].size(1), batch['decoder_input'].size(1))
+    logits = model(batch['encoder_input'], encoder_mask, batch['decoder_input'], decoder_mask)
+    unpacked = F.cross_entropy(logits.transpose(1, 2), batch['label'], ignore_index=0, reduction='none').sum(1)
+
+    packed = pack_batch(items, pad_id=0, seq_len=8)
+    encoder_mask, decoder_mask, cross_mask = make_packed_masks(packed['src_segments'], packed['tgt_segments'])
+    logits = model(packed['encoder_input'], encoder_mask, packed['decoder_input'], decoder_mask,
+                   cross_mask=cross_mask, src_positions=packed['src_positions'], tgt_positions=packed['tgt_positions'])
+    token_loss = F.cross_entropy(logits.transpose(1, 2), packed['label'], ignore_index=0, reduction='none')
+    assert packed['encoder_input'].size(0) < len(items)
+
+    # per pair loss: sum the token losses of every segment, in packed order
+    pair_loss = []
+    for row in range(token_loss.size(0)):
+        segments = packed['tgt_segments'][row]
+        pair_loss.extend(token_loss[row][segments == segment].sum() for segment in range(1, int(segments.max()) + 1))
+    order = [index for row in pack_rows(items, 8) for index in row]
+    torch.testing.assert_close(torch.stack(pair_loss), unpacked[order])
+
+    # and the chunked loss the training loop uses gives the same total
+    chunked = model(packed['encoder_input'], encoder_mask, packed['decoder_input'], decoder_mask, packed['label'], 0, 0.0, 4,
+                    cross_mask=cross_mask, src_positions=packed['src_positions'], tgt_positions=packed['tgt_positions'])
+    torch.testing.assert_close(chunked, unpacked.sum())
@@ -0,0 +1,36 @@
+import pytest
+import torch
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+
+from dataset import padding_mask
+from export import export_model
+from model import build_transformer
+from runtime import ExportedTranslator
+from train import greedy_decode
+
+@pytest.mark.parametrize('export_format', ['torchscript', 'onnx'])
+def test_runtime_matches_greedy_decode(tmp_path, export_format):
+    if export_format == 'onnx':
+        pytest.importorskip('onnxruntime')
+    words = [f'w{i}' for i in range(20)]
+    tokenizer = Tokenizer(WordLevel({token: i for i, token in enumerate(['[UNK]', '[PAD]', '[SOS]', '[EOS]'] + words)}, unk_token='[UNK]'))
+    tokenizer.pre_tokenizer = Whitespace()
+    tokenizer.save(str(tmp_path / 'tokenizer.json'))
+    torch.manual_seed(0)
+    model = build_transformer(24, 24, 32, 32, d_model=16, N=2, h=2, d_ff=32).eval()
+
+    export_model(model, tokenizer, tmp_path / 'export', export_format)
+    assert not model.training
+    translator = ExportedTranslator(tmp_path / 'export', tmp_path / 'tokenizer.json', tmp_path / 'tokenizer.json', max_len=12)
+
+    sentences = ['w1 w2 w3', 'w4 w5 w6 w7 w8 w9', 'w10']
+    expected = []
+    with torch.no_grad():
+        for sentence in sentences:
+            source = torch.tensor([[2] + tokenizer.encode(sentence).ids + [3]])
+            output = greedy_decode(model, source, padding_mask(torch.tensor([source.size(1)]), source.size(1)), tokenizer, tokenizer, 12, 'cpu')
+            # without the [SOS] the runtime does not return
+            expected.append(tokenizer.decode(output.tolist()[1:]))
+    assert translator.translate(sentences) == expected
@@ -0,0 +1,80 @@
+import warnings
+
+import pytest
+import torch
+
+from dataset import causal_mask, padding_mask
+from model import MultiHeadAttentionBlock, PositionalEncoding, build_transformer
+
+def test_sdpa_matches_math_attention():
+    torch.manual_seed(0)
+    query, key, value = torch.randn(3, 2, 4, 5, 8).unbind(0)
+    # causal & padding like the decoder mask: every query row keeps key 0
+    mask = padding_mask(torch.tensor([5, 3]), 5) & causal_mask(5)
+    expected, _ = MultiHeadAttentionBlock.attention(query, key, value, mask, None)
+    torch.testing.assert_close(MultiHeadAttentionBlock.sdpa_attention(query, key, value, mask, 0.0), expected)
+    # integer masks select the same positions
+    torch.testing.assert_close(MultiHeadAttentionBlock.sdpa_attention(query, key, value, mask.int(), 0.0), expected)
+
+@pytest.mark.parametrize('backend', ['math', 'sdpa'])
+def test_folded_cross_attention_matches_repeated_keys(backend):
+    # beam search passes Batch * Beams queries against the Batch encoder outputs
+    torch.manual_seed(0)
+    block = MultiHeadAttentionBlock(16, 2, 0.0, backend).eval()
+    beams = 3
+    query = torch.randn(2 * beams, 4, 16)
+    encoder_output = torch.randn(2, 6, 16)
+    mask = padding_mask(torch.tensor([6, 3]), 6)
+    with torch.no_grad():
+        folded = block(query, encoder_output, encoder_output, mask)
+        repeated_output = encoder_output.repeat_interleave(beams, dim=0)
+        expected = block(query, repeated_output, repeated_output, mask.repeat_interleave(beams, dim=0))
+    torch.testing.assert_close(folded, expected)
+
+def test_positional_encoding_grows_and_loads_old_checkpoints():
+    encoding = PositionalEncoding(8, 4, 0.0)
+    assert 'pe' not in encoding.state_dict()
+    # checkpoints from before the table was non-persistent carry it as 'pe'
+    encoding.load_state_dict({'pe': PositionalEncoding.sinusoids(4, 8)})
+
+    x = torch.zeros(1, 3, 8, dtype=torch.float64)
+    encoding.to(torch.float64)
+    out = encoding(x, start_pos=6)
+    assert encoding.pe.size(1) >= 9 and encoding.pe.dtype == torch.float64
+    torch.testing.assert_close(out, PositionalEncoding.sinusoids(9, 8)[:, 6:].double())
+
+def test_untied_checkpoint_in_tied_model_warns():
+    untied = build_transformer(12, 12, 8, 8, d_model=8, N=1, h=2, d_ff=16)
+    tied = build_transformer(12, 12, 8, 8, d_model=8, N=1, h=2, d_ff=16, tie_embeddings=True)
+    with pytest.warns(UserWarning, match='projection_layer.proj.weight'):
+        tied.load_state_dict(untied.state_dict())
+    torch.testing.assert_close(tied.projection_layer.proj.weight, untied.tgt_embed.embedding.weight)
+
+    # a tied checkpoint holds the same matrix under both keys and loads silently
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        tied.load_state_dict(tied.state_dict())
+        untied.load_state_dict(tied.state_dict())
+
+def test_cached_decode_matches_full_decode_and_reorders():
+    torch.manual_seed(0)
+    model = build_transformer(12, 12, 16, 16, d_model=8, N=2, h=2, d_ff=16).eval()
+    source = torch.randint(4, 12, (3, 5))
+    source_mask = torch.ones(3, 1, 1, 5, dtype=torch.bool)
+    target = torch.randint(4, 12, (3, 6))
+    causal = torch.tril(torch.ones(1, 6, 6, dtype=torch.bool))
+    with torch.no_grad():
+        encoder_output = model.encode(source, source_mask)
+        full = model.decode(encoder_output, source_mask, target, causal)
+
+        # one token at a time through the cache gives the same outputs as the full pass
+        cache = model.init_cache()
+        steps = [model.decode(encoder_output, source_mask, target[:, i:i + 1], None, cache) for i in range(4)]
+        torch.testing.assert_close(torch.cat(steps, dim=1), full[:, :4])
+        assert model.cache_len(cache) == 4
+
+        # after keeping rows 2 and 0 the cache continues those sequences only
+        index = torch.tensor([2, 0])
+        model.reorder_cache(cache, index)
+        step = model.decode(encoder_output[index], source_mask[index], target[index, 4:5], None, cache)
+        torch.testing.assert_close(step, full[index, 4:5])
@@ -0,0 +1,59 @@
+import asyncio
+import json
+
+from loadgen import http_request
+from server import BatchingServer
+from translation_cache import TranslationCache
+
+class FakeTranslator:
+    # upper-cases every sentence and records the batches it was given; raises on 'fail'
+
+    def __init__(self):
+        self.batches = []
+        self.cache = TranslationCache(16, 1)
+
+    def translate(self, sentences):
+        self.batches.append(sentences)
+        if 'fail' in sentences:
+            raise RuntimeError('decoding failed')
+        return [sentence.upper() for sentence in sentences]
+
+async def with_server(translator, requests, max_batch_size=32):
+    # runs the server on a free port for the duration of requests(port)
+    server = BatchingServer(translator, max_batch_size, max_wait_ms=50.0)
+    server.queue = asyncio.Queue()
+    batcher = asyncio.create_task(server.batcher())
+    listener = await asyncio.start_server(server.handle, '127.0.0.1', 0)
+    try:
+        return await requests(listener.sockets[0].getsockname()[1])
+    finally:
+        listener.close()
+        batcher.cancel()
+
+def ndjson(content):
+    return sorted((json.loads(line) for line in content.decode().splitlines()), key=lambda result: result['index'])
+
+def test_concurrent_requests_share_a_batch():
+    translator = FakeTranslator()
+
+    async def requests(port):
+        return await asyncio.gather(*(http_request('127.0.0.1', port, 'POST', '/translate', {'sentences': [f'w{i}']}) for i in range(4)))
+
+    responses = asyncio.run(with_server(translator, requests))
+    assert [ndjson(content) for content in responses] == [[{'index': 0, 'translation': f'W{i}'}] for i in range(4)]
+    assert len(translator.batches) == 1 and sorted(translator.batches[0]) == ['w0', 'w1', 'w2', 'w3']
+
+def test_bad_requests_get_400():
+    async def requests(port):
+        return [await http_request('127.0.0.1', port, 'POST', '/translate', body) for body in ([], {'sentences': 'a b'}, {'text': ['a']})]
+
+    for content in asyncio.run(with_server(FakeTranslator(), requests)):
+        assert 'error' in json.loads(content)
+
+def test_failed_batch_ends_the_stream():
+    async def requests(port):
+        return await http_request('127.0.0.1', port, 'POST', '/translate', {'sentences': ['a', 'fail']})
+
+    # max_batch_size 1 puts the sentences in separate batches, only the second one fails
+    results = ndjson(asyncio.run(with_server(FakeTranslator(), requests, max_batch_size=1)))
+    assert results == [{'index': 0, 'translation': 'A'}, {'index': 1, 'error': 'decoding failed'}]
@@ -0,0 +1,53 @@
+import torch
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+
+from dataset import padding_mask
+from model import build_transformer
+from train import batch_greedy_decode, beam_search_decode, greedy_decode, speculative_decode
+
+def make_tokenizer():
+    return Tokenizer(WordLevel({token: i for i, token in enumerate(['[UNK]', '[PAD]', '[SOS]', '[EOS]'] + [f'w{i}' for i in range(20)])}, unk_token='[UNK]'))
+
+def make_model(seed, num_layers=2):
+    torch.manual_seed(seed)
+    return build_transformer(24, 24, 32, 32, d_model=16, N=num_layers, h=2, d_ff=32).eval()
+
+def make_batch():
+    # right-padded sources of different lengths
+    lengths = torch.tensor([7, 4, 9])
+    source = torch.randint(4, 24, (3, 9), generator=torch.Generator().manual_seed(1))
+    source[torch.arange(9) >= lengths.unsqueeze(1)] = 1
+    return source, padding_mask(lengths, 9)
+
+def test_batch_greedy_matches_greedy():
+    model, tokenizer = make_model(0), make_tokenizer()
+    source, source_mask = make_batch()
+    with torch.no_grad():
+        batch = batch_greedy_decode(model, source, source_mask, tokenizer, 12, 'cpu')
+        for i in range(source.size(0)):
+            single = greedy_decode(model, source[i:i + 1], source_mask[i:i + 1], tokenizer, tokenizer, 12, 'cpu')
+            assert torch.equal(batch[i, :single.size(0)], single)
+
+def test_beam_search_with_one_beam_is_greedy():
+    model, tokenizer = make_model(0), make_tokenizer()
+    # beam search never picks [PAD] for a live beam, greedy decoding has no such rule
+    model.projection_layer.proj.bias.data[tokenizer.token_to_id('[PAD]')] = -100
+    source, source_mask = make_batch()
+    with torch.no_grad():
+        greedy = batch_greedy_decode(model, source, source_mask, tokenizer, 12, 'cpu')
+        beam = beam_search_decode(model, source, source_mask, tokenizer, 12, 'cpu', beam_size=1, length_penalty=0.0, max_len_a=0, max_len_b=12)
+    # the last position is where beam search forces [EOS]
+    assert torch.equal(beam[:, :11], greedy[:, :11])
+
+def test_speculative_matches_greedy():
+    model, tokenizer = make_model(0), make_tokenizer()
+    source, source_mask = make_batch()
+    with torch.no_grad():
+        greedy = batch_greedy_decode(model, source, source_mask, tokenizer, 12, 'cpu')
+        # a draft that disagrees most of the time, and the model as its own draft, which agrees always
+        for draft, k in [(make_model(1, 1), 3), (model, 4)]:
+            tokens, proposed, accepted = speculative_decode(model, draft, source, source_mask, tokenizer, 12, 'cpu', k)
+            assert torch.equal(tokens, greedy)
+            assert 0 <= accepted <= proposed
+        assert accepted == proposed
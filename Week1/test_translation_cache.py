@@ -0,0 +1,49 @@
+import torch
+
+from translation_cache import LRUCache, TranslationCache, tensor_bytes
+
+def test_lru_evicts_least_recently_used_by_size():
+    cache = LRUCache(100, tensor_bytes)
+    cache.put('a', torch.zeros(10)) # 40 bytes
+    cache.put('b', torch.zeros(10))
+    assert cache.get('a') is not None # 'b' is now the least recently used
+    cache.put('c', torch.zeros(10))
+    assert cache.size == 80 and 'b' not in cache.entries
+    assert cache.stats()['evictions'] == 1
+
+    # replacing an entry only counts the new value
+    cache.put('a', torch.zeros(5))
+    assert cache.size == 60
+    # a value larger than the whole cache is not stored and evicts nothing
+    cache.put('d', torch.zeros(100))
+    assert cache.size == 60 and set(cache.entries) == {'a', 'c'}
+    assert cache.stats()['hits'] == 1
+
+class CountingEncoder(torch.nn.Module):
+
+    def __init__(self, scale):
+        super().__init__()
+        self.scale = scale
+        self.rows = 0
+
+    def encode(self, source, source_mask):
+        self.rows += source.size(0)
+        return source.unsqueeze(-1).float().expand(-1, -1, 4) * self.scale
+
+def test_encoder_outputs_are_cached_per_model():
+    cache = TranslationCache(max_encoder_mb=1)
+    model, draft_model = CountingEncoder(1), CountingEncoder(-1)
+    source = torch.tensor([[5, 6, 7], [8, 9, 1]])
+    source_mask = (source != 1).view(2, 1, 1, 3)
+    lengths, keys = [3, 2], [(5, 6, 7), (8, 9)]
+
+    first = cache.encode(model, source, source_mask, lengths, keys)
+    again = cache.encode(model, source, source_mask, lengths, keys)
+    assert model.rows == 2
+    torch.testing.assert_close(again, first)
+    # padding positions come back as zeros, not as whatever the encoder produced there
+    assert again[1, 2].eq(0).all()
+
+    draft = cache.encode(draft_model, source, source_mask, lengths, keys, draft=True)
+    assert draft_model.rows == 2
+    torch.testing.assert_close(draft, -first)
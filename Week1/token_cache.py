@@ -0,0 +1,91 @@
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+class TokenCache:
+    # One side of a corpus as a flat int32 array of token ids plus an int64 offset index,
+    # both memory-mapped: sentence i is tokens[offsets[i]:offsets[i + 1]].
+
+    def __init__(self, tokens_path, offsets_path):
+        self.tokens_path = str(tokens_path)
+        self.offsets_path = str(offsets_path)
+        self._tokens = None
+        self._offsets = None
+
+    def _open(self):
+        # mapped lazily, so every DataLoader worker maps the same files and shares their pages
+        # mode 'c' (copy-on-write) gives writable arrays torch.from_numpy accepts without copying
+        self._offsets = np.memmap(self.offsets_path, dtype=np.int64, mode='c')
+        if self._offsets[-1] > 0:
+            self._tokens = np.memmap(self.tokens_path, dtype=np.int32, mode='c')
+        else:
+            self._tokens = np.zeros(0, dtype=np.int32)
+
+    def __getstate__(self):
+        # never pickle the mapped arrays, only where to find them
+        state = self.__dict__.copy()
+        state['_tokens'] = None
+        state['_offsets'] = None
+        return state
+
+    def __len__(self):
+        if self._offsets is None:
+            self._open()
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if self._offsets is None:
+            self._open()
+        # a view into the mapped file, no copy
+        return self._tokens[self._offsets[index]:self._offsets[index + 1]]
+
+    def lengths(self):
+        if self._offsets is None:
+            self._open()
+        return np.diff(self._offsets)
+
+def get_cache_key(ds, tokenizer, lang):
+    # the cache is only valid for this exact tokenizer and dataset
+    key = hashlib.sha1()
+    key.update(tokenizer.to_str().encode('utf-8'))
+    key.update(str(getattr(ds, '_fingerprint', len(ds))).encode('utf-8'))
+    key.update(lang.encode('utf-8'))
+    return key.hexdigest()[:16]
+
+def encode_corpus(ds, tokenizer, lang, batch_size=10000):
+    # ids of every ds[i]['translation'][lang] as int32 arrays, in order; each slice of batch_size
+    # sentences goes through encode_batch, which runs on the tokenizer's thread pool (RAYON_NUM_THREADS)
+    for start in range(0, len(ds), batch_size):
+        texts = [translation[lang] for translation in ds[start:start + batch_size]['translation']]
+        for encoding in tokenizer.encode_batch(texts):
+            yield np.asarray(encoding.ids, dtype=np.int32)
+
+def length_histogram(lengths, bin_width=16):
+    # (bin start, count) for every non-empty bin of bin_width tokens
+    counts = np.bincount(np.asarray(lengths, dtype=np.int64) // bin_width)
+    return [(i * bin_width, int(count)) for i, count in enumerate(counts) if count]
+
+def build_token_cache(ds, tokenizer, lang, cache_dir):
+    # encode every sentence of ds[i]['translation'][lang] once and store the ids on disk
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    key = get_cache_key(ds, tokenizer, lang)
+    tokens_path = cache_dir / f'{lang}_{key}.tokens.bin'
+    offsets_path = cache_dir / f'{lang}_{key}.offsets.bin'
+
+    if not offsets_path.exists():
+        tmp_tokens_path = tokens_path.with_suffix('.tmp')
+        tmp_offsets_path = offsets_path.with_suffix('.tmp')
+        offsets = [0]
+        with open(tmp_tokens_path, 'wb') as f:
+            for ids in encode_corpus(ds, tokenizer, lang):
+                f.write(ids.tobytes())
+                offsets.append(offsets[-1] + len(ids))
+        np.asarray(offsets, dtype=np.int64).tofile(tmp_offsets_path)
+
+        # the offsets file appears last, so a half-written cache is never picked up
+        tmp_tokens_path.replace(tokens_path)
+        tmp_offsets_path.replace(offsets_path)
+
+    return TokenCache(tokens_path, offsets_path)
@@ -1,11 +1,17 @@
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import Dataset, DataLoader, random_split
 
-from dataset import BilingualDataset, causal_mask
+from dataset import BilingualDataset, BucketBatchSampler, collate_batch, pack_batch, bucket_length, cached_causal_mask, padding_mask, make_masks, make_packed_masks
 from model import build_transformer
+from token_cache import build_token_cache, encode_corpus, length_histogram
+from checkpoint import CheckpointManager, get_rng_state, set_rng_state
+from metrics import MetricsLogger
+from distributed import launch, local_main_process_first, get_rank, get_world_size, is_main_process
 
-from config import get_weights_file_path, get_config
+from config import get_weights_file_path, get_config, get_draft_config, get_tokenizer_file_path
 
 from datasets import load_dataset
 from tokenizers import Tokenizer
@@ -18,24 +24,31 @@ from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
 from pathlib import Path
-
-def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device):
+from functools import partial
+import argparse
+from contextlib import ExitStack, nullcontext
+import os
+import resource
+import time
+
+def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_len, device, encoder_output=None):
     sos_idx = tokenizer_tgt.token_to_id('[SOS]')
     eos_idx = tokenizer_tgt.token_to_id('[EOS]')
 
     # precompute the encoder output and resue it for every token we get from the decoder
-    encoder_output = model.encode(source, source_mask)
+    # (callers with a TranslationCache may pass it in)
+    if encoder_output is None:
+        encoder_output = model.encode(source, source_mask)
+    # keys/values of the decoded prefix, so every step only runs the newest token
+    cache = model.init_cache()
     # initialize the decoder input with sos token
     decoder_input = torch.empty(1,1).fill_(sos_idx).type_as(source).to(device)
     while True:
         if decoder_input.size(1) == max_len:
             break
 
-        # Build mask for the target (decoder input)
-        decoder_mask = causal_mask(decoder_input.size(1)).type_as(source_mask).to(device)
-
-        # Calculate the output of the encoder
-        out = model.decode(encoder_output, source_mask, decoder_input, decoder_mask)
+        # The newest token may attend to every cached position, so no causal mask is needed
+        out = model.decode(encoder_output, source_mask, decoder_input[:, -1:], None, cache)
 
         # Get the next token
         prob = model.project(out[:,-1])
@@ -48,6 +61,183 @@ def greedy_decode(model, source, source_mask, tokenizer_src, tokenizer_tgt, max_
 
     return decoder_input.squeeze()
 
+def batch_greedy_decode(model, source, source_mask, tokenizer_tgt, max_len, device, encoder_output=None):
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+    batch_size = source.size(0)
+
+    if encoder_output is None:
+        encoder_output = model.encode(source, source_mask) # (B, Seq_Len, d_model)
+    cache = model.init_cache()
+
+    # (B, max_len), rows that emit [EOS] early stay padded after it
+    decoder_output = torch.full((batch_size, max_len), pad_idx, dtype=source.dtype, device=device)
+    decoder_output[:, 0] = sos_idx
+    # original row of every sequence that is still being decoded
+    active = torch.arange(batch_size, device=device)
+    next_word = decoder_output[:, :1]
+    for step in range(1, max_len):
+        out = model.decode(encoder_output, source_mask, next_word, None, cache)
+        prob = model.project(out[:, -1])
+        _, next_word = torch.max(prob, dim=1) # (B_active)
+        decoder_output[active, step] = next_word
+
+        # one host sync per step to find out how many rows are done
+        finished = next_word == eos_idx
+        num_finished = int(finished.sum())
+        if num_finished == active.size(0):
+            break
+        if num_finished > 0:
+            # compact finished rows out of the batch so they cost nothing in later steps
+            keep = (~finished).nonzero(as_tuple=True)[0]
+            active = active[keep]
+            next_word = next_word[keep]
+            encoder_output = encoder_output[keep]
+            source_mask = source_mask[keep]
+            model.reorder_cache(cache, keep)
+        next_word = next_word.unsqueeze(1) # (B_active, 1)
+
+    return decoder_output
+
+def beam_search_decode(model, source, source_mask, tokenizer_tgt, max_len, device, beam_size=4, length_penalty=0.6, max_len_a=1.2, max_len_b=10, encoder_output=None):
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+    batch_size = source.size(0)
+
+    # the encoder output stays (B, Seq_Len, d_model); attention broadcasts it over the beams
+    if encoder_output is None:
+        encoder_output = model.encode(source, source_mask)
+    cache = model.init_cache()
+
+    # every sentence may produce at most max_len_a * source_len + max_len_b tokens
+    src_len = source_mask.reshape(batch_size, -1).sum(dim=1)
+    limits = (max_len_a * src_len + max_len_b).long().clamp(max=max_len)
+    max_steps = int(limits.max())
+    limits = limits.repeat_interleave(beam_size) # (B * K)
+
+    # beams are folded into the batch: row b * beam_size + k is beam k of sentence b
+    tokens = torch.full((batch_size * beam_size, max_steps), pad_idx, dtype=source.dtype, device=device)
+    tokens[:, 0] = sos_idx
+    # only beam 0 starts alive, otherwise all beams would pick the same first token
+    scores = torch.full((batch_size, beam_size), float('-inf'), device=device)
+    scores[:, 0] = 0
+    scores = scores.view(-1) # (B * K)
+    finished = torch.zeros(batch_size * beam_size, dtype=torch.bool, device=device)
+    lengths = torch.zeros(batch_size * beam_size, dtype=torch.long, device=device)
+    beam_offsets = torch.arange(batch_size, device=device).unsqueeze(1) * beam_size # (B, 1)
+
+    next_word = tokens[:, :1]
+    for step in range(1, max_steps):
+        out = model.decode(encoder_output, source_mask, next_word, None, cache)
+        log_probs = model.project(out[:, -1]).float() # (B * K, tgt_vocab_size)
+        vocab_size = log_probs.size(-1)
+        not_eos = torch.arange(vocab_size, device=device) != eos_idx
+
+        # a beam that reached its length limit can only end
+        force_eos = (~finished) & (step >= limits - 1)
+        log_probs = log_probs.masked_fill(force_eos.unsqueeze(1) & not_eos, float('-inf'))
+        # finished beams extend with [PAD] for free so their score carries over, live beams never pick [PAD]
+        log_probs = log_probs.masked_fill(finished.unsqueeze(1), float('-inf'))
+        log_probs[:, pad_idx] = torch.zeros_like(scores).masked_fill(~finished, float('-inf'))
+
+        # (B * K, V) --> (B, K * V), then keep the best K continuations of every sentence
+        candidates = (scores.unsqueeze(1) + log_probs).view(batch_size, beam_size * vocab_size)
+        scores, indices = candidates.topk(beam_size, dim=1)
+        scores = scores.view(-1)
+        rows = (beam_offsets + torch.div(indices, vocab_size, rounding_mode='floor')).view(-1) # (B * K)
+        next_word = (indices % vocab_size).view(-1)
+
+        tokens = tokens[rows]
+        tokens[:, step] = next_word
+        lengths = lengths[rows] + (~finished[rows]).long()
+        finished = finished[rows] | (next_word == eos_idx)
+        model.reorder_cache(cache, rows, self_only=True)
+
+        if finished.all():
+            break
+        next_word = next_word.unsqueeze(1) # (B * K, 1)
+
+    # pick the best beam per sentence with the GNMT length penalty ((5 + len) / 6) ** alpha
+    normalized = scores / ((5 + lengths.float()) / 6) ** length_penalty
+    best = normalized.view(batch_size, beam_size).argmax(dim=1)
+    return tokens[beam_offsets.squeeze(1) + best]
+
+def speculative_decode(model, draft_model, source, source_mask, tokenizer_tgt, max_len, device, k=4, encoder_output=None, draft_encoder_output=None):
+    # Greedy decoding where the shallow draft_model proposes k tokens at a time and model checks all of
+    # them in a single decode pass. The result is model's own greedy translation: a draft token is only
+    # kept if model predicts the same, and the pass adds model's next token after the kept ones.
+    # All rows of a batch advance by the shortest kept prefix of any row, so they keep one length and
+    # one cache layout; rows that agree with the draft for longer recheck those tokens next round.
+    # Returns (B, max_len) tokens as batch_greedy_decode, and the number of draft tokens proposed and
+    # accepted summed over the rows.
+    sos_idx = tokenizer_tgt.token_to_id('[SOS]')
+    eos_idx = tokenizer_tgt.token_to_id('[EOS]')
+    pad_idx = tokenizer_tgt.token_to_id('[PAD]')
+    batch_size = source.size(0)
+
+    # callers with a TranslationCache may pass in the encoder outputs of either model
+    if encoder_output is None:
+        encoder_output = model.encode(source, source_mask)
+    if draft_encoder_output is None:
+        draft_encoder_output = draft_model.encode(source, source_mask)
+    # both caches hold every token except the newest one between rounds
+    cache, draft_cache = model.init_cache(), draft_model.init_cache()
+
+    # (B, max_len), rows that emit [EOS] early stay padded after it
+    decoder_output = torch.full((batch_size, max_len), pad_idx, dtype=source.dtype, device=device)
+    decoder_output[:, 0] = sos_idx
+    # original row of every sequence that is still being decoded, and its tokens so far
+    active = torch.arange(batch_size, device=device)
+    tokens = decoder_output[:, :1]
+    proposed, accepted = 0, 0
+    while tokens.size(1) < max_len:
+        steps = min(k, max_len - tokens.size(1))
+        # the draft first catches up on tokens it has not seen, then proposes one token per call
+        draft_tokens = tokens
+        for _ in range(steps):
+            cached = draft_model.cache_len(draft_cache)
+            out = draft_model.decode(draft_encoder_output, source_mask, draft_tokens[:, cached:], cached_causal_mask(cached, draft_tokens.size(1) - cached, device), draft_cache)
+            next_word = draft_model.project(out[:, -1]).argmax(dim=-1, keepdim=True)
+            draft_tokens = torch.cat([draft_tokens, next_word], dim=1)
+        proposals = draft_tokens[:, tokens.size(1):] # (B_active, steps)
+
+        # the full model runs the newest accepted token and all proposals at once
+        cached = model.cache_len(cache)
+        out = model.decode(encoder_output, source_mask, draft_tokens[:, cached:], cached_causal_mask(cached, draft_tokens.size(1) - cached, device), cache)
+        predicted = model.project(out).argmax(dim=-1) # (B_active, steps + 1)
+
+        # keep the longest prefix of proposals the full model agrees with in every row, then its own next token
+        num_accepted = int((proposals == predicted[:, :-1]).cumprod(dim=1).sum(dim=1).min())
+        proposed += steps * tokens.size(0)
+        accepted += num_accepted * tokens.size(0)
+        new_tokens = torch.cat([proposals[:, :num_accepted], predicted[:, num_accepted:num_accepted + 1]], dim=1)[:, :max_len - tokens.size(1)]
+        is_eos = new_tokens == eos_idx
+        after_eos = (is_eos.cumsum(dim=1) - is_eos.long()) > 0
+        decoder_output[active, tokens.size(1):tokens.size(1) + new_tokens.size(1)] = new_tokens.masked_fill(after_eos, pad_idx)
+        tokens = torch.cat([tokens, new_tokens], dim=1)
+        # drop the keys/values of rejected proposals
+        model.trim_cache(cache, tokens.size(1) - 1)
+        draft_model.trim_cache(draft_cache, tokens.size(1) - 1)
+
+        # one host sync per round to find out how many rows are done
+        finished = is_eos.any(dim=1)
+        num_finished = int(finished.sum())
+        if num_finished == active.size(0):
+            break
+        if num_finished > 0:
+            # compact finished rows out of the batch so they cost nothing in later rounds
+            keep = (~finished).nonzero(as_tuple=True)[0]
+            active = active[keep]
+            tokens = tokens[keep]
+            encoder_output = encoder_output[keep]
+            draft_encoder_output = draft_encoder_output[keep]
+            source_mask = source_mask[keep]
+            model.reorder_cache(cache, keep)
+            draft_model.reorder_cache(draft_cache, keep)
+
+    return decoder_output, proposed, accepted
 
 def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len, device, print_msg, global_state, writer, num_examples=2):
     model.eval()
@@ -61,26 +251,31 @@ def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len,
     console_width = 80
     with torch.no_grad():
         for batch in validation_ds:
-            count += 1
-            encoder_input = batch['encoder_input'].to(device)
-            encoder_mask = batch['encoder_mask'].to(device)
+            encoder_input = batch['encoder_input'].to(device) # (B, Seq_Len)
+            encoder_mask = padding_mask(batch['src_len'].to(device), encoder_input.size(1)) # (B, 1, 1, Seq_Len)
 
-            assert encoder_input.size(0) == 1, 'Batch size must be 1 for validation'
+            # don't decode more sentences than we are going to show (num_examples=None runs the whole split)
+            if num_examples is not None:
+                encoder_input = encoder_input[:num_examples - count]
+                encoder_mask = encoder_mask[:num_examples - count]
 
-            model_out = greedy_decode(model, encoder_input, encoder_mask, tokenizer_src, tokenizer_tgt, max_len, device)
-            source_text = batch['src_text'][0]
-            target_text = batch['tgt_text'][0]
-            model_out_text = tokenizer_tgt.decode(model_out.detach().cpu().numpy())
+            model_out = batch_greedy_decode(model, encoder_input, encoder_mask, tokenizer_tgt, max_len, device).cpu()
 
-            # source_texts.append(source_text)
-            # expected.append(target_text)
-            # predicted.append(model_out_text)
+            for i in range(model_out.size(0)):
+                count += 1
+                source_text = batch['src_text'][i]
+                target_text = batch['tgt_text'][i]
+                model_out_text = tokenizer_tgt.decode(model_out[i].tolist())
 
-            # Print to the console
-            print_msg('-'*console_width)
-            print_msg(f'SOURCE: {source_text}')
-            print_msg(f'TARGET: {target_text}')
-            print_msg(f'PREDICTED: {model_out_text}')
+                # source_texts.append(source_text)
+                # expected.append(target_text)
+                # predicted.append(model_out_text)
+
+                # Print to the console
+                print_msg('-'*console_width)
+                print_msg(f'SOURCE: {source_text}')
+                print_msg(f'TARGET: {target_text}')
+                print_msg(f'PREDICTED: {model_out_text}')
 
             if count == num_examples:
                 break
@@ -89,126 +284,413 @@ def run_validation(model, validation_ds, tokenizer_src, tokenizer_tgt, max_len,
     # TorchMetrics, CharErrorRate, BLEU, WordErrorRate
 
 
+def validation_loss(model, validation_ds, loss_fn, pad_id, config, device):
+    # teacher-forced loss per target token over the whole validation split, computed like the training loss
+    model.eval()
+    total_loss = torch.zeros((), device=device)
+    total_tokens = 0
+    with torch.no_grad():
+        for batch in validation_ds:
+            encoder_input = batch['encoder_input'].to(device) # (B, Seq_Len)
+            decoder_input = batch['decoder_input'].to(device) # (B, Seq_Len)
+            label = batch['label'].to(device) # (B, Seq_Len)
+            encoder_mask, decoder_mask = make_masks(batch['src_len'].to(device), batch['tgt_len'].to(device), encoder_input.size(1), decoder_input.size(1))
+            if config['loss_chunk_size']:
+                total_loss += model(encoder_input, encoder_mask, decoder_input, decoder_mask, label, pad_id, config['label_smoothing'], config['loss_chunk_size'])
+            else:
+                proj_output = model(encoder_input, encoder_mask, decoder_input, decoder_mask)
+                total_loss += loss_fn(proj_output.view(-1, proj_output.size(-1)), label.view(-1))
+            total_tokens += int(batch['tgt_len'].sum())
+    return total_loss.item() / max(total_tokens, 1)
+
 def get_all_sentences(ds, lang):
     for item in ds:
         yield item['translation'][lang]
 
 def get_or_build_tokenizer(config, ds, lang):
     # config['tokenizer_file'] = '../tokenizers/tokenizer_{0}/json'
-    Tokenizer_path = Path(config['tokenizer_file'].format(lang))
+    Tokenizer_path = Path(get_tokenizer_file_path(config, lang))
     if not Path.exists(Tokenizer_path):
         tokenizer = Tokenizer(WordLevel(unk_token="[UNK]"))
         tokenizer.pre_tokenizer = Whitespace()
         trainer = WordLevelTrainer(special_tokens=["[UNK]", "[PAD]", "[SOS]", "[EOS]"], min_frequency=2)
-        tokenizer.train_from_iterator(get_all_sentences(ds, lang), trainer=trainer)
+        # a joint vocabulary is trained on both sides of the corpus
+        langs = [config['lang_src'], config['lang_tgt']] if config['share_embeddings'] else [lang]
+        tokenizer.train_from_iterator((sentence for l in langs for sentence in get_all_sentences(ds, l)), trainer=trainer)
         tokenizer.save(str(Tokenizer_path))
     else:
         tokenizer = Tokenizer.from_file(str(Tokenizer_path))
     return tokenizer
 
+def configure_process(config):
+    # environment variables libraries read once, when they first start; set at process start (before
+    # launch, whose local processes inherit them) instead of by the functions that happen to use them
+    if config['tokenizer_threads']:
+        # size of the tokenizers thread pool
+        os.environ['RAYON_NUM_THREADS'] = str(config['tokenizer_threads'])
+    if config['compile']:
+        # inductor's on-disk caches, so a restarted run reuses the compiled graphs and kernels
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = str(Path(config['compile_cache_dir']).absolute())
+
 def get_ds(config):
     ds_raw = load_dataset('opus_books', f'{config["lang_src"]}-{config["lang_tgt"]}', split='train')
 
     # Build tokenizers
-    tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
-    tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
+    with local_main_process_first():
+        tokenizer_src = get_or_build_tokenizer(config, ds_raw, config['lang_src'])
+        tokenizer_tgt = get_or_build_tokenizer(config, ds_raw, config['lang_tgt'])
 
     # keep 90% for training and 10% for validation
+    # seeded, so every data-parallel process and every resumed run gets the same split
     train_ds_size = int(0.9 * len(ds_raw))
     val_ds_size = len(ds_raw) - train_ds_size
-    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size])
-
-    train_ds = BilingualDataset(train_ds_raw,  tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], seq_len=config['seq_len'])
-    val_ds = BilingualDataset(val_ds_raw,  tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], seq_len=config['seq_len'])
-
-    max_len_src, max_len_tgt = 0, 0
-    for item in ds_raw:
-        src_ids = tokenizer_src.encode(item['translation'][config['lang_src']]).ids
-        tgt_ids = tokenizer_tgt.encode(item['translation'][config['lang_tgt']]).ids
-        max_len_src = max(max_len_src, len(src_ids))
-        max_len_tgt = max(max_len_tgt, len(tgt_ids))
-
-    print(f'Max length of source sentence: {max_len_src}')
-    print(f'Max length of target sentence: {max_len_tgt}')
-
-    train_dataloader = DataLoader(train_ds, batch_size=config['batch_size'], shuffle=True)
-    val_dataloader = DataLoader(val_ds, batch_size=1, shuffle=True)
+    train_ds_raw, val_ds_raw = random_split(ds_raw, [train_ds_size, val_ds_size], generator=torch.Generator().manual_seed(config['seed']))
+
+    tokenize_start = time.perf_counter()
+    if config['token_cache_dir']:
+        # tokenize the corpus once, later runs and epochs only read the memory-mapped ids
+        with local_main_process_first():
+            src_cache = build_token_cache(ds_raw, tokenizer_src, config['lang_src'], config['token_cache_dir'])
+            tgt_cache = build_token_cache(ds_raw, tokenizer_tgt, config['lang_tgt'], config['token_cache_dir'])
+        # the lengths come with the encoding pass, as the cache offsets
+        src_lens = src_cache.lengths().tolist()
+        tgt_lens = tgt_cache.lengths().tolist()
+    else:
+        # no cache on disk: the ids of the whole corpus are kept in memory, items are never encoded one by one
+        src_cache = list(encode_corpus(ds_raw, tokenizer_src, config['lang_src']))
+        tgt_cache = list(encode_corpus(ds_raw, tokenizer_tgt, config['lang_tgt']))
+        src_lens = [len(ids) for ids in src_cache]
+        tgt_lens = [len(ids) for ids in tgt_cache]
+    tokenize_time = time.perf_counter() - tokenize_start
+
+    train_ds = BilingualDataset(train_ds_raw,  tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], seq_len=config['seq_len'], dynamic_padding=config['dynamic_padding'], src_cache=src_cache, tgt_cache=tgt_cache)
+    val_ds = BilingualDataset(val_ds_raw,  tokenizer_src, tokenizer_tgt, config['lang_src'], config['lang_tgt'], seq_len=config['seq_len'], dynamic_padding=config['dynamic_padding'], src_cache=src_cache, tgt_cache=tgt_cache)
+
+    # padded length every pair needs: [SOS] + src + [EOS] on the encoder side, [SOS] + tgt on the decoder side
+    pair_lengths = [max(src_len + 2, tgt_len + 1) for src_len, tgt_len in zip(src_lens, tgt_lens)]
+    # compiled models get a few fixed padded lengths instead of one per batch, so they do not recompile
+    pad_buckets = sorted({min(bucket, config['seq_len']) for bucket in config['pad_buckets']} | {config['seq_len']}) if config['compile'] else None
+    if pad_buckets:
+        pair_lengths = [bucket_length(length, pad_buckets) for length in pair_lengths]
+    max_len_src, max_len_tgt = max(src_lens), max(tgt_lens)
+
+    if is_main_process():
+        print(f'Tokenized {len(ds_raw)} pairs in {tokenize_time:.2f} s')
+        print(f'Max length of source sentence: {max_len_src}')
+        print(f'Max length of target sentence: {max_len_tgt}')
+        print('Source length histogram:', ', '.join(f'{start}+: {count}' for start, count in length_histogram(src_lens)))
+        print('Target length histogram:', ', '.join(f'{start}+: {count}' for start, count in length_histogram(tgt_lens)))
+
+    collate_fn = partial(collate_batch, pad_id=tokenizer_tgt.token_to_id('[PAD]'), pad_buckets=pad_buckets)
+    # dynamic padding: batches of similar lengths, padded only to their own longest sequence
+    # fixed padding: bucket_size 1 only sorts inside a batch, so batches stay fully random
+    # the sampler's per-epoch seed also lets a resumed run skip the batches it already saw
+    bucket_size = config['bucket_size'] if config['dynamic_padding'] else 1
+    max_tokens = config['max_tokens'] if config['dynamic_padding'] else None
+    # the training batches are sharded over data-parallel processes, validation only runs on rank 0
+    if config['packing']:
+        # packing: about batch_size rows of seq_len tokens per batch, filled with whole pairs by pack_batch;
+        # bucket_size 1 leaves lengths mixed within a batch, which lets pack_batch fill its rows tighter
+        train_sampler = BucketBatchSampler([pair_lengths[i] for i in train_ds_raw.indices], config['batch_size'], config['batch_size'] * config['seq_len'], 1, seed=config['seed'], num_replicas=get_world_size(), rank=get_rank(), packed=True)
+        train_collate_fn = partial(pack_batch, pad_id=tokenizer_tgt.token_to_id('[PAD]'), seq_len=config['seq_len'], pad_buckets=pad_buckets)
+    else:
+        train_sampler = BucketBatchSampler([pair_lengths[i] for i in train_ds_raw.indices], config['batch_size'], max_tokens, bucket_size, seed=config['seed'], num_replicas=get_world_size(), rank=get_rank())
+        train_collate_fn = collate_fn
+    val_sampler = BucketBatchSampler([pair_lengths[i] for i in val_ds_raw.indices], config['val_batch_size'], bucket_size=bucket_size, seed=config['seed'])
+    train_dataloader = DataLoader(train_ds, batch_sampler=train_sampler, collate_fn=train_collate_fn, num_workers=config['num_workers'])
+    val_dataloader = DataLoader(val_ds, batch_sampler=val_sampler, collate_fn=collate_fn, num_workers=config['num_workers'])
 
     return train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt
 
 def get_model(config, vocab_src_Len, vocab_tgt_Len):
-    model = build_transformer(vocab_src_Len, vocab_tgt_Len, config['seq_len'], config['seq_len'], config['d_model'])
+    model = build_transformer(vocab_src_Len, vocab_tgt_Len, config['seq_len'], config['seq_len'], config['d_model'], config['num_layers'], attention_backend=config['attention_backend'],
+                              encoder_checkpoint_every=config['encoder_checkpoint_every'], decoder_checkpoint_every=config['decoder_checkpoint_every'],
+                              tie_embeddings=config['tie_embeddings'], share_embeddings=config['share_embeddings'],
+                              layer_norm_unbiased=config['layer_norm_unbiased'])
     return model
 
+def compile_settings(config):
+    # dynamo/inductor settings while compiled models run (compilation happens on their first calls),
+    # restored afterwards so nothing else in the process is affected
+    if not config['compile']:
+        return nullcontext()
+    import torch._dynamo
+    import torch._inductor.config
+    settings = ExitStack()
+    # graphs cached on disk, in compile_cache_dir (configure_process)
+    settings.enter_context(torch._inductor.config.patch(fx_graph_cache=True))
+    # static shapes: one graph per batch size and (source, target) bucket pair, the default limit of 8 would fall back to eager
+    settings.enter_context(torch._dynamo.config.patch(cache_size_limit=max(torch._dynamo.config.cache_size_limit, 4 * (len(config['pad_buckets']) + 1) ** 2)))
+    return settings
+
+def compile_model(fn, dynamic=False):
+    # call the result under compile_settings(config)
+    return torch.compile(fn, dynamic=dynamic)
+
+class CompiledDecoding:
+    # model with its encoder pass and single-step decoder pass under torch.compile, for greedy_decode and
+    # batch_greedy_decode. The decoder step is compiled with dynamic shapes: the cache grows by one
+    # position per token and finished rows drop out of the batch.
+
+    def __init__(self, model):
+        self.model = model
+        self.encode = compile_model(model.encode)
+        self.decode = compile_model(model.decode, dynamic=True)
+        self.project = compile_model(model.project, dynamic=True)
+
+    def __getattr__(self, name):
+        # init_cache, reorder_cache, eval, ... of the model itself
+        return getattr(self.model, name)
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+def get_autocast_dtype(config, device):
+    # None means plain fp32; bfloat16 on CPUs and recent GPUs, float16 (with a GradScaler) on older GPUs
+    if not config['mixed_precision']:
+        return None
+    if device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        return torch.float16
+    return torch.bfloat16
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # peak resident set size of the process, reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+def group_batches(batches, size):
+    # consecutive groups of up to size batches, the micro-batches of one optimizer step
+    group = []
+    for batch in batches:
+        group.append(batch)
+        if len(group) == size:
+            yield group
+            group = []
+    if group:
+        yield group
+
 def train_model(config):
+    # the compile settings hold for this training run only
+    with compile_settings(config):
+        run_training(config)
+
+def run_training(config):
     # Define the device
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-    print(f'Using device {device}')
+    world_size = get_world_size()
+    main_process = is_main_process()
+    if main_process:
+        print(f'Using device {device}, {world_size} process(es)')
 
     Path(config['model_folder']).mkdir(parents=True, exist_ok=True)
     train_dataloader, val_dataloader, tokenizer_src, tokenizer_tgt = get_ds(config)
-    model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
-    # Tensorboard
-    Writer = SummaryWriter(config['experiment_name'])
+    # the unwrapped model is used for checkpoints and validation, the DDP wrapper for training steps
+    model = raw_model = get_model(config, tokenizer_src.get_vocab_size(), tokenizer_tgt.get_vocab_size()).to(device)
+    # Tensorboard, only written by rank 0
+    if main_process:
+        Writer = SummaryWriter(config['experiment_name'])
+        metrics = MetricsLogger(Writer, log_every=config['log_every'])
 
     optimizer = torch.optim.Adam(model.parameters(), lr=config['lr'], eps=1e-09)
 
+    # summed over tokens and divided by the non-pad target tokens of the whole optimizer step (see below)
+    pad_id = tokenizer_src.token_to_id('[PAD]')
+    loss_fn = nn.CrossEntropyLoss(ignore_index=pad_id, label_smoothing=config['label_smoothing'], reduction='sum').to(device)
+
+    autocast_dtype = get_autocast_dtype(config, device)
+    if main_process:
+        print(f'Autocast dtype: {autocast_dtype}')
+    # only float16 needs loss scaling, bfloat16 has the same range as float32
+    scaler = torch.amp.GradScaler(device.type, enabled=autocast_dtype == torch.float16)
+
+    checkpoints = CheckpointManager(config, keep_last=config['keep_checkpoints'])
+
     initial_epoch = 0
+    start_batch = 0
     global_step = 0
-    if config['preload']:
-        model_filename = get_weights_file_path(config, config['preload'])
-        print(f'Preloading model {model_filename}')
-        state = torch.load(model_filename)
-        initial_epoch = state['epoch'] + 1
+    # 'latest' resumes from the newest checkpoint in model_folder, or starts from scratch if there is none yet
+    model_filename = checkpoints.latest() if config['preload'] == 'latest' else config['preload'] and get_weights_file_path(config, config['preload'])
+    if config['preload'] == 'latest' and model_filename is None and main_process:
+        print(f"No checkpoint in {config['model_folder']} yet, starting from scratch")
+    if model_filename:
+        if main_process:
+            print(f'Preloading model {model_filename}')
+        state = torch.load(model_filename, map_location=device, weights_only=False)
+        # the seed fixes the train/validation split and the batch order, resuming with another one
+        # would train on validation pairs and repeat or skip batches
+        if state.get('seed', config['seed']) != config['seed']:
+            raise ValueError(f"{model_filename} was trained with seed {state['seed']}, not {config['seed']}")
+        raw_model.load_state_dict(state['model_state_dict'])
         optimizer.load_state_dict(state['optimizer_state_dict'])
         global_step = state['global_step']
-    
-    loss_fn = nn.CrossEntropyLoss(ignore_index=tokenizer_src.token_to_id('[PAD]'), label_smoothing=0.1).to(device)
+        if 'scaler_state_dict' in state:
+            scaler.load_state_dict(state['scaler_state_dict'])
+        if 'rng_state' in state:
+            set_rng_state(state['rng_state'])
+        if state.get('batch_in_epoch') is not None:
+            # saved in the middle of an epoch: continue it after the batches already seen
+            initial_epoch = state['epoch']
+            start_batch = state['batch_in_epoch']
+        else:
+            initial_epoch = state['epoch'] + 1
+
+    if world_size > 1:
+        # every process starts from rank 0's weights and averages gradients over gloo
+        model = DistributedDataParallel(raw_model)
+
+    if config['compile']:
+        # compiled after the DDP wrapper, so the gradient all-reduce overlaps with the compiled backward
+        model = compile_model(model)
+        decoding_model = CompiledDecoding(raw_model)
+    else:
+        decoding_model = raw_model
+
+    def training_state(epoch, batch_in_epoch):
+        return {
+            'epoch': epoch,
+            'batch_in_epoch': batch_in_epoch, # None once the epoch is complete
+            'model_state_dict': raw_model.state_dict(),
+            'optimizer_state_dict': optimizer.state_dict(),
+            'scaler_state_dict': scaler.state_dict(),
+            'rng_state': get_rng_state(),
+            'global_step': global_step,
+            'seed': config['seed']
+        }
 
     for epoch in range(initial_epoch, config['num_epochs']):
         model.train()
-        batch_iterator = tqdm(train_dataloader, desc=f"Processing Epoch {epoch:02d}")
-        for batch in batch_iterator:
-            encoder_input = batch['encoder_input'].to(device) # (B, Seq_Len)
-            decoder_input = batch['decoder_input'].to(device) # (B, Seq_Len)
-            encoder_mask = batch['encoder_mask'].to(device) # (B, 1, 1, Seq_len)
-            decoder_mask = batch['decoder_mask'].to(device) # (B, 1, Seq_Len, Seq_Len)
-            label = batch['label'].to(device) # (B, Seq_Len)
-
-            # Run the tensors through the transformer
-            encoder_output = model.encode(encoder_input, encoder_mask) # (B, Seq_Len, d_model)
-            decoder_output = model.decode(encoder_output, encoder_mask, decoder_input, decoder_mask) # (B, Seq_Len, d_model)
-            proj_output  = model.project(decoder_output) # (B, Seq_Len, tgt_vocab_size)
-
-            # (B, Seq_Len, tgt_vocab_size) --> (B * Seq_Len, tgt_vocab_size)
-            loss = loss_fn(proj_output.view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1))
-            batch_iterator.set_postfix({"loss": f"{loss.item(): 6.3f}"})
-
-            # log the loss
-            Writer.add_scalar('train loss', loss.item(), global_step)
-            Writer.flush()
-
-            # Backpropagate the loss
-            loss.backward()
+        train_dataloader.batch_sampler.set_epoch(epoch, start_batch if epoch == initial_epoch else 0)
+        # redraw the progress bar at most every log_every batches
+        batch_iterator = tqdm(train_dataloader, desc=f"Processing Epoch {epoch:02d}", miniters=config['log_every'], disable=not main_process)
+        epoch_start = time.perf_counter()
+        epoch_tokens = 0
+        epoch_steps = 0
+        batch_in_epoch = start_batch if epoch == initial_epoch else 0
+        # compiled models: steps with a shape not seen before include compilation, time them separately
+        seen_shapes = set()
+        warmup_time, warmup_steps, steady_time, steady_steps = 0.0, 0, 0.0, 0
+        for micro_batches in group_batches(batch_iterator, config['accum_steps']):
+            step_start = time.perf_counter()
+            # normalizing by the non-pad target tokens of all micro-batches together (not by their
+            # count) gives exactly the gradient of one large batch, whatever the padding
+            # target lengths are still on the host, counting them costs no device sync
+            step_tokens = sum(int(batch['tgt_len'].sum()) for batch in micro_batches)
+            epoch_tokens += step_tokens
+            if world_size > 1:
+                # DDP averages the gradients over the processes: divide by the tokens of the global
+                # step and scale back up by world_size to get the single-large-batch gradient
+                global_tokens = torch.tensor(step_tokens)
+                dist.all_reduce(global_tokens)
+                global_step_tokens = int(global_tokens)
+                loss_scale = world_size / global_step_tokens
+            else:
+                global_step_tokens = step_tokens
+                loss_scale = 1 / step_tokens
+            step_loss = torch.zeros((), device=device)
+
+            for i, batch in enumerate(micro_batches):
+                encoder_input = batch['encoder_input'].to(device) # (B, Seq_Len)
+                decoder_input = batch['decoder_input'].to(device) # (B, Seq_Len)
+                label = batch['label'].to(device) # (B, Seq_Len)
+                if config['packing']:
+                    # block-diagonal masks from the segment ids, positions restart for every pair
+                    encoder_mask, decoder_mask, cross_mask = make_packed_masks(batch['src_segments'].to(device), batch['tgt_segments'].to(device))
+                    packed = {'cross_mask': cross_mask, 'src_positions': batch['src_positions'].to(device), 'tgt_positions': batch['tgt_positions'].to(device)}
+                else:
+                    # only the lengths cross to the device, the masks are built there: (B, 1, 1, Seq_len), (B, 1, Seq_Len, Seq_Len)
+                    encoder_mask, decoder_mask = make_masks(batch['src_len'].to(device), batch['tgt_len'].to(device), encoder_input.size(1), decoder_input.size(1))
+                    packed = {}
+
+                # gradients are only all-reduced after the last micro-batch of the step
+                last_micro_batch = i == len(micro_batches) - 1
+                with model.no_sync() if world_size > 1 and not last_micro_batch else nullcontext():
+                    with torch.autocast(device_type=device.type, dtype=autocast_dtype, enabled=autocast_dtype is not None):
+                        if config['loss_chunk_size']:
+                            # projection and label-smoothed cross-entropy fused and chunked, no full-vocab tensor
+                            loss = model(encoder_input, encoder_mask, decoder_input, decoder_mask, label, pad_id, config['label_smoothing'], config['loss_chunk_size'], **packed) * loss_scale
+                        else:
+                            # Run the tensors through the transformer
+                            proj_output = model(encoder_input, encoder_mask, decoder_input, decoder_mask, **packed) # (B, Seq_Len, tgt_vocab_size)
+
+                            # (B, Seq_Len, tgt_vocab_size) --> (B * Seq_Len, tgt_vocab_size)
+                            loss = loss_fn(proj_output.view(-1, tokenizer_tgt.get_vocab_size()), label.view(-1)) * loss_scale
+
+                    # Backpropagate the loss, gradients add up over the micro-batches
+                    scaler.scale(loss).backward()
+                step_loss += loss.detach()
 
             # update the weights
-            optimizer.step()
+            scaler.step(optimizer)
+            scaler.update()
             optimizer.zero_grad()
 
+            if config['compile']:
+                synchronize(device)
+                step_time = time.perf_counter() - step_start
+                shapes = {(tuple(batch['encoder_input'].shape), tuple(batch['decoder_input'].shape)) for batch in micro_batches}
+                if shapes - seen_shapes:
+                    seen_shapes |= shapes
+                    warmup_time += step_time
+                    warmup_steps += 1
+                else:
+                    steady_time += step_time
+                    steady_steps += 1
+
             global_step += 1
+            epoch_steps += 1
+            batch_in_epoch += len(micro_batches)
+
+            # log the loss, the device is only synced once every log_every steps
+            # with several processes this is rank 0's share scaled to the global step, an estimate
+            if main_process:
+                metrics.add('train loss', step_loss)
+                metrics.add('tokens per optimizer step', global_step_tokens)
+                averages = metrics.step(global_step)
+                if averages is not None:
+                    batch_iterator.set_postfix({"loss": f"{averages['train loss']: 6.3f}", "tokens/step": f"{averages['tokens per optimizer step']:.0f}"}, refresh=False)
+
+            if main_process and config['checkpoint_every'] and global_step % config['checkpoint_every'] == 0:
+                checkpoints.save(f'{epoch:02d}_{global_step}', training_state(epoch, batch_in_epoch))
+
+        # throughput and memory of this epoch, to compare precision settings
+        epoch_time = time.perf_counter() - epoch_start
+        if world_size > 1:
+            # tokens of all processes, one collective per epoch
+            total_tokens = torch.tensor(epoch_tokens)
+            dist.all_reduce(total_tokens)
+            epoch_tokens = int(total_tokens)
+
+        if not main_process:
+            continue
+
+        batch_iterator.write(f'Epoch {epoch:02d}: {epoch_tokens / epoch_time:.0f} target tokens/s, {epoch_tokens / max(epoch_steps, 1):.0f} target tokens per optimizer step, peak memory {peak_memory_mb(device):.0f} MB')
+        metrics.log('train tokens per second', epoch_tokens / epoch_time, epoch)
+        if config['compile']:
+            batch_iterator.write(f'Epoch {epoch:02d}: compile warm-up {warmup_time:.1f} s over {warmup_steps} steps with new shapes, steady state {1000 * steady_time / max(steady_steps, 1):.1f} ms/step')
+            metrics.log('compile warm-up seconds', warmup_time, epoch)
         
         # Run validation at the end of every epoch
-        run_validation(model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step, Writer)
+        run_validation(decoding_model, val_dataloader, tokenizer_src, tokenizer_tgt, config['seq_len'], device, lambda msg: batch_iterator.write(msg), global_step, Writer)
 
-        # save the model at the end of every epoch
-        model_filename = get_weights_file_path(config, f'{epoch:02d}')
-        torch.save({
-            'epoch': epoch,
-            'model_state_dict': model.state_dict(),
-            'optimizer_state_dict': optimizer.state_dict(),
-            'global_step': global_step
-        }, model_filename)
+        # the best checkpoint is the one with the lowest validation loss
+        val_loss = validation_loss(raw_model, val_dataloader, loss_fn, pad_id, config, device)
+        batch_iterator.write(f'Epoch {epoch:02d}: validation loss {val_loss:.4f}')
+        metrics.log('validation loss', val_loss, epoch)
+
+        # save the model at the end of every epoch, written in the background
+        checkpoints.save(f'{epoch:02d}', training_state(epoch, None), metric=val_loss)
+
+    checkpoints.close()
+    if main_process:
+        metrics.close()
 
 if __name__ == '__main__':
-    config = get_config()
-    train_model(config)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Train the Week1 Transformer')
+    parser.add_argument('--draft', action='store_true', help='train the shallow draft model for speculative decoding instead')
+    args = parser.parse_args()
+    config = get_draft_config(get_config()) if args.draft else get_config()
+    configure_process(config)
+    # single process, local processes (world_size > 1) or torchrun across hosts
+    launch(train_model, config)
\ No newline at end of file
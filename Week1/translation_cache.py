@@ -0,0 +1,100 @@
+from collections import OrderedDict
+
+import torch
+
+class LRUCache:
+    # An OrderedDict in recency order. The least recently used entries are evicted once the summed
+    # size_fn(value) goes over max_size; the default size of 1 per value makes max_size an entry count.
+
+    def __init__(self, max_size, size_fn=None):
+        self.max_size = max_size
+        self.size_fn = size_fn or (lambda value: 1)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        size = self.size_fn(value)
+        if size > self.max_size:
+            # would not fit even alone, keep the current entries instead
+            return
+        if key in self.entries:
+            self.size -= self.size_fn(self.entries.pop(key))
+        self.entries[key] = value
+        self.size += size
+        while self.size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= self.size_fn(evicted)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'size': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else None,
+        }
+
+def tensor_bytes(tensor):
+    return tensor.element_size() * tensor.nelement()
+
+class TranslationCache:
+    # Two cache levels in front of the decoders, both keyed on source token ids (so sentences that only
+    # differ in whitespace share entries):
+    # translations: finished output per (decoding mode, source ids), limited to max_translations entries;
+    #   the mode is the decoder that produced the entry, so a lookup only finds output of the same decoder
+    # encoder_outputs: (Src_Len, d_model) encoder output per source ids, limited to max_encoder_mb; any
+    #   decoding mode can use them and skip Transformer.encode
+    # draft_encoder_outputs: the same for the draft model of speculative decoding, with its own max_encoder_mb
+
+    def __init__(self, max_translations=10000, max_encoder_mb=256):
+        self.translations = LRUCache(max_translations)
+        self.encoder_outputs = LRUCache(max_encoder_mb * 2**20, tensor_bytes)
+        self.draft_encoder_outputs = LRUCache(max_encoder_mb * 2**20, tensor_bytes)
+
+    @staticmethod
+    def key(ids):
+        return tuple(ids)
+
+    def encode(self, model, source, source_mask, lengths, keys, draft=False):
+        # (B, Seq_Len, d_model) encoder output of the batch, running the encoder only on the rows that are
+        # not cached; lengths are the unpadded source lengths (host ints), keys one per row, draft selects
+        # the draft model's cache
+        cache = self.draft_encoder_outputs if draft else self.encoder_outputs
+        outputs = [cache.get(key) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if missing:
+            longest = max(lengths[i] for i in missing)
+            index = torch.tensor(missing, device=source.device)
+            encoded = model.encode(source[index, :longest], source_mask[index][..., :longest])
+            for row, i in enumerate(missing):
+                # a copy: a view would keep the whole batch's encoder output alive in the cache
+                outputs[i] = encoded[row, :lengths[i]].clone()
+                cache.put(keys[i], outputs[i])
+
+        # back into one padded batch; padding positions are masked out of the cross-attention
+        encoder_output = outputs[0].new_zeros(len(outputs), source.size(1), outputs[0].size(-1))
+        for i, output in enumerate(outputs):
+            encoder_output[i, :output.size(0)] = output
+        return encoder_output
+
+    def stats(self):
+        return {
+            'translations': self.translations.stats(),
+            'encoder_outputs': self.encoder_outputs.stats(),
+            'draft_encoder_outputs': self.draft_encoder_outputs.stats(),
+        }